@@ -9,7 +9,7 @@ def main() -> None:
     """
     with open("resources/text_corpus.txt", 'r') as input_file:
         my_graph = build_inverted_index_graph('input_stream', doc_column='doc_id', text_column='text')
-        with open("results/tf_idf.txt", 'w') as output_file:
+        with open("results/tf_idf.txt", 'wb') as output_file:
             my_graph.run(input_stream=input_file, output_stream=output_file)
 
 
@@ -9,7 +9,7 @@ def main() -> None:
     """
     with open("resources/text_corpus.txt", 'r') as input_file:
         my_graph = build_word_count_graph('input_stream', count_column='count', text_column='text')
-        with open("results/word_count.txt", 'w') as output_file:
+        with open("results/word_count.txt", 'wb') as output_file:
             my_graph.run(input_stream=input_file, output_stream=output_file)
 
 
@@ -1,8 +1,9 @@
-from .src.graph import Graph
+from .src.graph import Graph, batched_mapper, fold_primitive, DEFAULT_CACHE_DIR
 import logging
 
 
-logger = logging.getLogger()
+# Only the logger of the library is configured, logging of applications is left as is
+logger = logging.getLogger(__name__)
 handler = logging.StreamHandler()
 # handler = logging.FileHandler('logger_output_file.txt')
 
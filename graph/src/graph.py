@@ -1,15 +1,154 @@
 import logging
 import json
-from itertools import groupby, chain
-from typing import Union, Tuple, Callable, Iterable, Iterator, Any, List, Dict
+from abc import ABC, abstractmethod
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import groupby, chain, islice, repeat
+from operator import itemgetter
+from typing import Union, Tuple, Callable, Iterable, Iterator, Any, List, Dict, Optional
+from types import CodeType
+from bisect import bisect_right
+import copy
+import hashlib
+import heapq
 import io
+import os
+import pickle
+import sys
+import tempfile
+import threading
+
+try:
+    import orjson
+except ImportError:  # optional dependency, stdlib json is used instead
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
+BATCH_SIZE = 4096
+SORT_BUFFER_SIZE = 200000
+SPILL_CHUNK_SIZE = 1024
+HASH_JOIN_MEMORY_LIMIT = 64 * 1024 * 1024
+OUTPUT_BUFFER_SIZE = 64 * 1024
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.compgraph_cache')
+
+# Memoized results are not reused after the library code has changed
+with open(__file__, 'rb') as engine_source:
+    ENGINE_FINGERPRINT = hashlib.blake2b(engine_source.read(), digest_size=16).hexdigest()
+
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(record: Dict) -> bytes:
+        """
+        Serializes record to json. Records, which orjson can not serialize (e.g. integers
+        wider than 64 bits), are serialized by the standard json module
+        :param record: dict to serialize
+        :return: bytes, utf-8 encoded json
+        """
+        try:
+            return orjson.dumps(record, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            return json.dumps(record, separators=(',', ':'), ensure_ascii=False).encode()
+else:
+    json_loads = json.loads
+
+    def json_dumps(record: Dict) -> bytes:
+        """
+        Serializes record to json
+        :param record: dict to serialize
+        :return: bytes, utf-8 encoded json
+        """
+        return json.dumps(record, separators=(',', ':'), ensure_ascii=False).encode()
+
+
+def batched_mapper(mapper: Callable) -> Callable:
+    """
+    Marks mapper as a batched one. Batched mapper is called once for a list of records
+    (up to BATCH_SIZE records) instead of once for every record, so the per-record
+    interpreter overhead is paid inside one call.
+    :param mapper: mapper function, which takes a list of records and yields result records
+    :return: returns the same mapper function
+    """
+    mapper._is_batched = True
+    return mapper
+
+
+FOLD_PRIMITIVES = {
+    'sum': lambda batch, column: sum(map(itemgetter(column), batch)),
+    'count': lambda batch, column: len(batch),
+    'min': lambda batch, column: min(map(itemgetter(column), batch)),
+    'max': lambda batch, column: max(map(itemgetter(column), batch)),
+}
+FOLD_COMBINERS = {
+    'sum': lambda value, batch_value: value + batch_value,
+    'count': lambda value, batch_value: value + batch_value,
+    'min': lambda value, batch_value: batch_value if value is None else min(value, batch_value),
+    'max': lambda value, batch_value: batch_value if value is None else max(value, batch_value),
+}
+
+
+def fold_primitive(kind: str, column: str) -> Callable:
+    """
+    Marks folder as a known accumulator of one column of state: 'sum' and 'min'/'max' aggregate
+    the column of records with the same name, 'count' counts records. Marked folder is not called
+    for every record: Fold aggregates every micro-batch with a builtin function and combines the results
+    :param kind: kind of accumulator ('sum', 'count', 'min', 'max')
+    :param column: name of column in state (and in records for 'sum', 'min' and 'max')
+    :return: returns decorator, which returns the same folder function
+    """
+    if kind not in FOLD_PRIMITIVES:
+        raise ValueError("Incorrect fold primitive {}. Possible variants: sum, count, min, max".format(kind))
+
+    def decorator(folder: Callable) -> Callable:
+        folder._fold_primitive = (kind, column)
+        return folder
+    return decorator
+
+
+SPECIALIZED_READER_TEMPLATE = """
+def read(source):
+    records = map(loads, source) if isinstance(source, TextIOBase) else source
+    return ({{{fields}}} for record in records)
+"""
+_specialized_readers = {}
+
+
+def specialized_reader(schema: Dict[str, type]) -> Callable:
+    """
+    Generates and compiles reader of input stream for fixed schema of records. Column names
+    and type conversions are hardcoded in the source of the reader, so records are built by
+    a single dict display. Readers are cached by schema
+    :param schema: dict with names of columns and their types (object means no conversion)
+    :return: returns reader function, which takes json text stream or iterable with dicts
+    and returns iterator with records projected to columns of schema
+    """
+    schema_key = tuple(schema.items())
+    reader = _specialized_readers.get(schema_key)
+    if reader is not None:
+        return reader
+
+    namespace = {'loads': json_loads, 'TextIOBase': io.TextIOBase}
+    fields = []
+    for index, (column, column_type) in enumerate(schema.items()):
+        value = 'record[{!r}]'.format(column)
+        if column_type is not object:
+            namespace['type_{}'.format(index)] = column_type
+            value = 'type_{}({})'.format(index, value)
+        fields.append('{!r}: {}'.format(column, value))
+    source = SPECIALIZED_READER_TEMPLATE.format(fields=', '.join(fields))
+    exec(compile(source, '<specialized reader>', 'exec'), namespace)
+    reader = _specialized_readers[schema_key] = namespace['read']
+    return reader
+
 
 class Graph(object):
     """Class that allows you to create and run computational graphs."""
 
+    # Incremented on every join: ancestors of a graph change only when some graph gets a new parent
+    _topology_version = 0
+
     def __init__(self, source: Union[str, 'Graph'], name: str = None) -> None:
         """
         Constructs a new 'Graph' object.
@@ -24,7 +163,6 @@ class Graph(object):
             if isinstance(source, Graph):
                 self._source_is_graph = True
                 source._count_of_calls += 1
-                source._remained_count_of_calls += 1
                 self._parent_graphs.append(source)
             elif isinstance(source, str):
                 self._source_is_graph = False
@@ -38,11 +176,19 @@ class Graph(object):
         self._name = name
 
         self._count_of_calls = 0
-        self._remained_count_of_calls = 0
         self._output = None
         self._nodes = []
-        self._cache = []
-        self._is_checked_in_sort = False
+        self._plan = None
+        self._compile_count = 0
+        self._cache = ColumnarCache()
+        self._lock = threading.Lock()
+        self._is_cached = False
+        self._spill_cache = False
+        self._schema = None
+        self._read_specialized = None
+        self._topological_sort_cache = None
+        # (columns, reverse) of the last sort, if no operation after it could change order of records
+        self._sorted_by = None
 
     def map(self, mapper: Callable) -> None:
         """
@@ -52,6 +198,8 @@ class Graph(object):
         """
         new_map_node = Map(mapper)
         self._nodes.append(new_map_node)
+        self._plan = None
+        self._sorted_by = None
 
     def sort(self, *columns: str, reverse: bool = False) -> None:
         """
@@ -61,8 +209,15 @@ class Graph(object):
         :param reverse: False if you need increase sort, True otherwise
         :return: returns nothing
         """
+        columns = tuple(dict.fromkeys(columns))  # repeated column does not change order
+        if self._sorted_by is not None and self._sorted_by[1] == reverse \
+                and self._sorted_by[0][:len(columns)] == columns:
+            # data is already sorted by these columns, the sort would not change anything
+            return
         new_sort_node = Sort(*columns, reverse=reverse)
         self._nodes.append(new_sort_node)
+        self._plan = None
+        self._sorted_by = (columns, reverse)
 
     def fold(self, folder: Callable, initial_state: Any) -> None:
         """
@@ -73,6 +228,8 @@ class Graph(object):
         """
         new_fold_node = Fold(folder, initial_state)
         self._nodes.append(new_fold_node)
+        self._plan = None
+        self._sorted_by = None
 
     def reduce(self, reducer: Callable, key: Union[str, Tuple[str, str]]) -> None:
         """
@@ -83,6 +240,8 @@ class Graph(object):
         """
         new_reduce_node = Reduce(reducer, key)
         self._nodes.append(new_reduce_node)
+        self._plan = None
+        self._sorted_by = None
 
     def join(self, on: 'Graph', strategy: str, key: Union[str, Tuple[str, str]] = None) -> None:
         """
@@ -92,14 +251,48 @@ class Graph(object):
         :param key: is None for cross join, otherwise it is a tuple (length = 2) with names
         of columns that participate in join. First name in tuple is a name of column in
         left graph (from which you calls join), second name in tuple is a name of column
-        in right graph (which is passed as parameter 'on')
+        in right graph (which is passed as parameter 'on').
+        Joined rows are not sorted by key if the join is run as hash join: they follow the order
+        of left table (of right table for right join)
         :return: returns nothing
         """
-        on._remained_count_of_calls += 1
         on._count_of_calls += 1
         new_join_node = Join(on, strategy, key)
         self._nodes.append(new_join_node)
+        self._plan = None
+        self._sorted_by = None
         self._parent_graphs.append(on)
+        Graph._topology_version += 1
+
+    def cache(self, spill: bool = False) -> None:
+        """
+        Materializes output of the graph on every run, so every consumer gets its own iterator over
+        the same records and the graph is computed only once. Output of a graph with several consumers
+        is materialized anyway, this method allows to keep it in a temporary file instead of memory
+        :param spill: False keeps records in memory, True writes them to a temporary file
+        :return: returns nothing
+        """
+        self._is_cached = True
+        self._spill_cache = spill
+
+    def _output_is_cached(self) -> bool:
+        """
+        :return: True if output of the graph is materialized, False if it is a lazy iterator
+        """
+        return self._is_cached or self._count_of_calls > 1
+
+    def specialize(self, schema: Dict[str, type]) -> None:
+        """
+        Specializes the graph for fixed schema of input records: reader of input stream is generated
+        for the schema and compiled once, records are projected to columns of schema and converted
+        to their types. The reader is used by every run instead of dispatch by type of input stream
+        :param schema: dict with names of columns and their types (object means no conversion)
+        :return: returns nothing
+        """
+        if self._source_is_graph:
+            raise ValueError("Only graph with input stream as a source can be specialized")
+        self._schema = dict(schema)
+        self._read_specialized = specialized_reader(self._schema)
 
     def _internal_run(self, **kwargs: Any) -> None:
         """
@@ -107,13 +300,15 @@ class Graph(object):
         :param kwargs: parameters, used for internal run
         :return: returns nothing
         """
-        logger.info("Graph {} is running".format(self._name))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Graph %s is running", self._name)
         if self._source_is_graph:
-            if self._source._count_of_calls > 1:
+            if self._source._output_is_cached():
                 node_output = self._source.get_generator_from_output_cache()
-                self._source._remained_count_of_calls -= 1
             else:
                 node_output = self._source._output
+        elif self._read_specialized is not None:
+            node_output = self._read_specialized(kwargs[self._source])
         else:
             try:
                 if isinstance(kwargs[self._source], io.TextIOWrapper):
@@ -128,63 +323,370 @@ class Graph(object):
                 logger.exception(e)
                 raise
 
-        for node in self._nodes:
-            node_output = node.run(node_output)
+        if self._plan is None:
+            self.compile()
+        node_batches = to_batches(node_output)
+        for node in self._plan:
+            node_batches = node.batched_run(node_batches)
+        node_output = chain.from_iterable(node_batches)
         self._output = node_output
 
-        if self._count_of_calls > 1:
-            for record in node_output:
-                self._cache.append(record)
-            self._output = None
+        if self._output_is_cached():
+            cache = SpilledCache() if self._spill_cache else ColumnarCache()
+            cache.extend(node_output)
+            with self._lock:
+                self._cache = cache
+                self._output = None
 
-        logger.info("Computation of graph {} is done".format(self._name))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Computation of graph %s is done", self._name)
 
-    def _topological_sort(self) -> List['Graph']:
+    def _fingerprint(self, kwargs: Dict) -> Optional[str]:
+        """
+        Computes fingerprint of graph result: hash of its input streams and of all operations
+        of the graph and its parent graphs
+        :param kwargs: dict of all input arguments for graph running
+        :return: hex digest or None if some input stream can not be fingerprinted
         """
-        Makes topological sort of graphs by deep first search algorithm
+        if self._source_is_graph:
+            source_fingerprint = self._source._fingerprint(kwargs)
+        else:
+            source_fingerprint = input_fingerprint(kwargs.get(self._source))
+        if source_fingerprint is None:
+            return None
+
+        hasher = hashlib.blake2b((ENGINE_FINGERPRINT + source_fingerprint).encode(), digest_size=16)
+        if self._schema is not None:
+            hasher.update(repr(sorted((column, column_type.__name__)
+                                      for column, column_type in self._schema.items())).encode())
+        for node in self._nodes:
+            node_fingerprint = node.fingerprint(kwargs)
+            if node_fingerprint is None:
+                return None
+            hasher.update(type(node).__name__.encode())
+            hasher.update(node_fingerprint)
+        return hasher.hexdigest()
+
+    def compile(self) -> None:
+        """
+        Builds execution plan of the graph from its nodes. Runs of consecutive (not batched) Map nodes
+        are fused into one FusedMap node, so records do not cross a generator boundary between them.
+        Sort followed by Reduce with the same key is fused into one SortedGroupBy node.
+        The plan is built once and reused by every run until a new operation is added to the graph.
         :return: returns nothing
         """
-        graphs_in_topological_order = [self]
-        stack_with_graphs = [self]
-        self._is_checked_in_sort = True
-        while len(stack_with_graphs) > 0:
-            current_graph = stack_with_graphs.pop()
-            for parent_graph in current_graph._parent_graphs:
-                if not parent_graph._is_checked_in_sort:
-                    parent_graph._is_checked_in_sort = True
-                    stack_with_graphs.append(parent_graph)
-                    graphs_in_topological_order.append(parent_graph)
-        graphs_in_topological_order.reverse()
-        return graphs_in_topological_order
+        plan = []
+        for node in self._nodes:
+            if isinstance(node, Map) and not node._is_batched:
+                if plan and isinstance(plan[-1], FusedMap):
+                    plan[-1].add(node._mapper)
+                else:
+                    plan.append(FusedMap(node._mapper))
+            elif isinstance(node, Reduce) and plan and isinstance(plan[-1], Sort) \
+                    and plan[-1]._columns == node._key:
+                plan[-1] = SortedGroupBy(plan[-1], node)
+            else:
+                plan.append(node)
+        self._plan = plan
+        self._compile_count += 1
+
+    def _topological_sort(self) -> Tuple[List['Graph'], List[List['Graph']]]:
+        """
+        Makes topological sort of graphs by Kahn's algorithm (every graph goes after all its parent graphs)
+        and computes eviction points: outputs of a parent graph are not needed after its last consumer
+        in topological order has been run. The result is cached until some graph is joined with another one
+        :return: returns tuple of list with graphs in topological order and list with lists of graphs,
+        which outputs can be dropped after the graph with the same index has been run
+        """
+        if self._topological_sort_cache is not None and \
+                self._topological_sort_cache[0] == Graph._topology_version:
+            return self._topological_sort_cache[1]
+
+        graphs = [self]
+        in_degree = {self: 0}
+        child_graphs = defaultdict(list)
+        for graph in graphs:
+            parent_graphs = list(dict.fromkeys(graph._parent_graphs))
+            in_degree[graph] = len(parent_graphs)
+            for parent_graph in parent_graphs:
+                child_graphs[parent_graph].append(graph)
+                if parent_graph not in in_degree:
+                    in_degree[parent_graph] = 0
+                    graphs.append(parent_graph)
+
+        graphs_in_topological_order = [graph for graph in graphs if in_degree[graph] == 0]
+        for graph in graphs_in_topological_order:
+            for child_graph in child_graphs[graph]:
+                in_degree[child_graph] -= 1
+                if in_degree[child_graph] == 0:
+                    graphs_in_topological_order.append(child_graph)
+
+        last_consumer_index = {}
+        for index, graph in enumerate(graphs_in_topological_order):
+            for parent_graph in graph._parent_graphs:
+                last_consumer_index[parent_graph] = index
+        evict_after = [[] for _ in graphs_in_topological_order]
+        for parent_graph, index in last_consumer_index.items():
+            evict_after[index].append(parent_graph)
+
+        self._topological_sort_cache = (Graph._topology_version, (graphs_in_topological_order, evict_after))
+        return graphs_in_topological_order, evict_after
 
     def get_generator_from_output_cache(self) -> Iterator:
-        for record in self._cache:
-            yield record
+        """
+        Returns iterator over cached output of graph. The iterator holds the cached columns itself,
+        so it stays valid after the graph drops its cache
+        :return: iterator with records
+        """
+        with self._lock:
+            return iter(self._cache)
+
+    def _drop_output(self) -> None:
+        """
+        Drops output and cache of graph when all consumers of the graph have taken them
+        :return: returns nothing
+        """
+        with self._lock:
+            self._cache = ColumnarCache()
+            self._output = None
 
-    def run(self, output_stream: io.TextIOWrapper = None, verbose: bool = False, **kwargs) -> List[Dict]:
+    def _run_concurrently(self, graphs_in_topological_order: List['Graph'], max_workers: int,
+                          **kwargs: Any) -> None:
+        """
+        Runs graphs in a pool of threads: every graph is submitted as soon as all its parent graphs are done.
+        Output of a cached graph (explicitly or as a graph with several consumers) is computed in the pool,
+        so independent cached branches are computed at the same time; output of other graphs stays lazy and
+        is computed by the thread of its consumer. Output of a parent graph is dropped when all its consumers
+        are done. Error of a graph is raised here or while its lazy output is consumed
+        :param graphs_in_topological_order: graphs to run
+        :param max_workers: number of threads
+        :param kwargs: parameters, used for internal run
+        :return: returns nothing
+        """
+        graphs_to_run = set(graphs_in_topological_order)
+        parents_to_wait = {}
+        pending_consumers = Counter()
+        for graph in graphs_in_topological_order:
+            parents_to_wait[graph] = set(graph._parent_graphs) & graphs_to_run
+            for parent_graph in set(graph._parent_graphs):
+                pending_consumers[parent_graph] += 1
+
+        done = set()
+        waiting = list(graphs_in_topological_order)
+        running = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while waiting or running:
+                for graph in [graph for graph in waiting if done.issuperset(parents_to_wait[graph])]:
+                    waiting.remove(graph)
+                    running[executor.submit(graph._internal_run, **kwargs)] = graph
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    graph = running.pop(future)
+                    future.result()
+                    done.add(graph)
+                    for parent_graph in set(graph._parent_graphs):
+                        pending_consumers[parent_graph] -= 1
+                        if pending_consumers[parent_graph] == 0:
+                            parent_graph._drop_output()
+
+    def run(self, output_stream: Union[io.TextIOBase, io.BufferedIOBase] = None, verbose: bool = False,
+            cache_dir: str = None, max_workers: int = 1, **kwargs) -> List[Dict]:
         """
         Runs graph
-        :param output_stream: opened file for writing
+        :param output_stream: opened file (text or binary) for writing
         :param verbose: parameter for logging. True sets INFO logging level, False sets ERROR logging level
+        :param cache_dir: directory for memoization of graph results (e.g. DEFAULT_CACHE_DIR), None disables it.
+        Result is memoized only if all input streams are files opened for reading; the key is a hash
+        of files (path, modification time, size), of all graph operations with global values they refer to
+        and of the library code
+        :param max_workers: number of threads running independent graphs concurrently, 1 runs graphs
+        one by one in topological order. Only cached graphs are computed concurrently (mark independent
+        heavy branches with cache to run them in parallel), so memory is the same as for a serial run:
+        outputs of cached graphs are held until their consumers are done, other outputs are streamed
         :param kwargs: dict of all input arguments for graph running
         :return: list of dicts, result of computing graph
         """
         if verbose:
             logger.setLevel(logging.INFO)
 
-        graphs_in_topological_order = self._topological_sort()
-        for graph_to_run in graphs_in_topological_order:
-            graph_to_run._internal_run(**kwargs)
+        cache_path = None
+        if cache_dir is not None:
+            fingerprint = self._fingerprint(kwargs)
+            if fingerprint is not None:
+                cache_path = os.path.join(cache_dir, fingerprint + '.pkl')
 
+        if cache_path is not None and os.path.exists(cache_path):
+            logger.info("Graph %s result is loaded from %s", self._name, cache_path)
+            with open(cache_path, 'rb') as cache_file:
+                output = pickle.load(cache_file)
+        else:
+            graphs_in_topological_order, evict_after = self._topological_sort()
+            if max_workers > 1:
+                self._run_concurrently(graphs_in_topological_order, max_workers, **kwargs)
+            else:
+                for index, graph_to_run in enumerate(graphs_in_topological_order):
+                    graph_to_run._internal_run(**kwargs)
+                    for graph_to_evict in evict_after[index]:
+                        graph_to_evict._drop_output()
+            output = self.get_generator_from_output_cache() if self._output_is_cached() else self._output
+
+            if cache_path is not None:
+                output = list(output)
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(cache_path + '.tmp', 'wb') as cache_file:
+                    pickle.dump(output, cache_file)
+                os.replace(cache_path + '.tmp', cache_path)
+
+        # graph does not keep its consumed output (or cache) between runs
         if output_stream is not None:
-            for record in self._output:
-                output_stream.write(json.dumps(record) + "\n")
+            write_json_lines(output_stream, output)
+            self._drop_output()
             return []
         else:
-            return list(self._output)
+            result = list(output)
+            self._drop_output()
+            return result
+
+
+class ColumnarCache(object):
+    """
+    Class represents cached table stored by columns: a list of values for every column instead
+    of a dict for every row. If records with different sets of columns are added,
+    the cache falls back to a list of records
+    """
+
+    def __init__(self) -> None:
+        """
+        Constructs a new empty 'ColumnarCache' object
+        :return: returns nothing
+        """
+        self._schema = None
+        self._columns = []
+        self._rows = None
+
+    def extend(self, records: Iterable) -> None:
+        """
+        Adds records to the cache
+        :param records: records to add
+        :return: returns nothing
+        """
+        for record in records:
+            if self._rows is not None:
+                self._rows.append(record)
+                continue
+            if self._schema is None:
+                self._schema = tuple(record)
+                self._columns = [[] for _ in self._schema]
+            elif tuple(record) != self._schema:
+                self._rows = list(self)
+                self._columns = []
+                self._rows.append(record)
+                continue
+            for column, value in zip(self._columns, record.values()):
+                column.append(value)
+
+    def __len__(self) -> int:
+        """
+        :return: number of cached records
+        """
+        if self._rows is not None:
+            return len(self._rows)
+        return len(self._columns[0]) if self._columns else 0
+
+    def __iter__(self) -> Iterator:
+        """
+        Returns iterator over cached records. Columns are captured when iterator is created,
+        so it stays valid after the cache is dropped
+        :return: iterator with new dict for every record
+        """
+        if self._rows is not None:
+            return iter(self._rows)
+        if not self._columns:
+            return iter(())
+        return map(dict, map(zip, repeat(self._schema), zip(*self._columns)))
+
+
+class SpilledCache(object):
+    """
+    Class represents cached table stored in a temporary file by pickled chunks of SPILL_CHUNK_SIZE records.
+    Every iterator reads chunks by their offsets, so several iterators may read the file at the same time
+    """
+
+    def __init__(self) -> None:
+        """
+        Constructs a new empty 'SpilledCache' object
+        :return: returns nothing
+        """
+        self._file = tempfile.TemporaryFile()
+        self._chunks = []
+        self._length = 0
+        self._lock = threading.Lock()
+
+    def extend(self, records: Iterable) -> None:
+        """
+        Adds records to the cache
+        :param records: records to add
+        :return: returns nothing
+        """
+        records = iter(records)
+        for chunk in iter(lambda: list(islice(records, SPILL_CHUNK_SIZE)), []):
+            data = pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL)
+            with self._lock:
+                self._file.seek(0, io.SEEK_END)
+                self._chunks.append((self._file.tell(), len(data)))
+                self._file.write(data)
+            self._length += len(chunk)
+
+    def __len__(self) -> int:
+        """
+        :return: number of cached records
+        """
+        return self._length
+
+    def __iter__(self) -> Iterator:
+        """
+        Returns iterator over cached records. Chunks and file are captured when iterator is created,
+        so it stays valid after the cache is dropped
+        :return: iterator with records
+        """
+        return self._read(self._file, list(self._chunks))
+
+    def _read(self, spill_file: Any, chunks: List[Tuple[int, int]]) -> Iterator:
+        """
+        Reads chunks of records from temporary file
+        :param spill_file: temporary file with pickled chunks
+        :param chunks: list of (offset, size) pairs of chunks
+        :return: yield records
+        """
+        for offset, size in chunks:
+            with self._lock:
+                spill_file.seek(offset)
+                data = spill_file.read(size)
+            yield from pickle.loads(data)
+
+
+class Node(ABC):
+    """Base class of nodes in Graph execution plan"""
+
+    @abstractmethod
+    def run(self, input_generator: Iterator) -> Iterator:
+        """
+        Runs node over records
+        :param input_generator: input for node
+        :return: returns generator with output records
+        """
+
+    def batched_run(self, input_batches: Iterator[List]) -> Iterator[List]:
+        """
+        Runs node over micro-batches of records. By default records are flattened, passed to run
+        and batched again, nodes which process records one by one override it
+        :param input_batches: input for node, lists of records
+        :return: returns iterator with lists of output records
+        """
+        return to_batches(self.run(chain.from_iterable(input_batches)))
 
 
-class Map(object):
+class Map(Node):
     """Class represents Map node in Graph"""
 
     def __init__(self, mapper: Callable) -> None:
@@ -194,15 +696,83 @@ class Map(object):
         :return: returns nothing
         """
         self._mapper = mapper
+        self._is_batched = getattr(mapper, '_is_batched', False)
 
     def run(self, input_generator: Iterator) -> Iterator:
         """
-        Runs map node
+        Runs Map node over records through micro-batches
         :param input_generator: input for map node
         :return: returns generator, result of application mapper function
         """
-        for record in input_generator:
-            yield from self._mapper(record)
+        return chain.from_iterable(self.batched_run(to_batches(input_generator)))
+
+    def batched_run(self, input_batches: Iterator[List]) -> Iterator[List]:
+        """
+        Runs map node over micro-batches of records: batched mapper gets the whole micro-batch,
+        other mappers get records one by one. In execution plan runs of other mappers
+        are fused into FusedMap nodes by Graph.compile
+        :param input_batches: input for map node, lists of records
+        :return: returns generator with lists of records, result of application mapper function
+        """
+        mapper = self._mapper
+        for batch in input_batches:
+            if self._is_batched:
+                output_batch = list(mapper(batch))
+            else:
+                output_batch = [output for record in batch for output in mapper(record)]
+            if output_batch:
+                yield output_batch
+
+    def fingerprint(self, kwargs: Dict) -> Optional[bytes]:
+        """
+        Returns fingerprint of map node
+        :param kwargs: dict of all input arguments for graph running
+        :return: bytes, hash of mapper function or None if it can not be computed
+        """
+        return callable_fingerprint(self._mapper)
+
+
+class FusedMap(Node):
+    """Class represents a chain of Map nodes fused into one node of Graph execution plan"""
+
+    def __init__(self, mapper: Callable) -> None:
+        """
+        Constructs a new 'FusedMap' object
+        :param mapper: first mapper function of the chain
+        :return: returns nothing
+        """
+        self._mappers = [mapper]
+
+    def add(self, mapper: Callable) -> None:
+        """
+        Appends mapper function to the end of the chain
+        :param mapper: mapper function
+        :return: returns nothing
+        """
+        self._mappers.append(mapper)
+
+    def run(self, input_generator: Iterator) -> Iterator:
+        """
+        Runs fused map node. Every mapper is applied with C-level map and chain, so the whole chain
+        is a single lazy iterator without python frames between mappers
+        :param input_generator: input for fused map node
+        :return: returns iterator, result of application of all mapper functions
+        """
+        node_output = input_generator
+        for mapper in self._mappers:
+            node_output = chain.from_iterable(map(mapper, node_output))
+        return node_output
+
+    def batched_run(self, input_batches: Iterator[List]) -> Iterator[List]:
+        """
+        Runs fused map node over micro-batches of records
+        :param input_batches: input for fused map node, lists of records
+        :return: returns generator with lists of records, result of application of all mapper functions
+        """
+        for batch in input_batches:
+            output_batch = list(self.run(batch))
+            if output_batch:
+                yield output_batch
 
 
 def json_to_generator(input_stream: io.TextIOWrapper) -> Iterator:
@@ -211,8 +781,154 @@ def json_to_generator(input_stream: io.TextIOWrapper) -> Iterator:
     :param input_stream: input text stream
     :return: returns generator with json transformed to dict
     """
+    loads = json_loads
     for line in input_stream:
-        yield json.loads(line)
+        yield loads(line)
+
+
+def is_binary_stream(output_stream: Any) -> bool:
+    """
+    Checks if stream takes bytes. Streams, which are not known to be binary, are written with str
+    :param output_stream: opened file or any object with write method
+    :return: True for binary streams, False otherwise
+    """
+    if isinstance(output_stream, (io.BufferedIOBase, io.RawIOBase)):
+        return True
+    mode = getattr(output_stream, 'mode', None)
+    return isinstance(mode, str) and 'b' in mode
+
+
+def write_json_lines(output_stream: Union[io.TextIOBase, io.BufferedIOBase], records: Iterable) -> None:
+    """
+    Writes records to stream as json lines. Lines are collected in a buffer and written by chunks
+    of OUTPUT_BUFFER_SIZE bytes. Binary streams get the encoded json directly, text streams get it decoded
+    :param output_stream: opened file (text or binary) for writing
+    :param records: records to write
+    :return: returns nothing
+    """
+    is_binary = is_binary_stream(output_stream)
+    dumps = json_dumps
+    buffer = bytearray()
+    for record in records:
+        buffer += dumps(record)
+        buffer += b"\n"
+        if len(buffer) >= OUTPUT_BUFFER_SIZE:
+            # the buffer is reused, so stream gets its copy
+            output_stream.write(bytes(buffer) if is_binary else buffer.decode())
+            buffer.clear()
+    if buffer:
+        output_stream.write(bytes(buffer) if is_binary else buffer.decode())
+
+
+def input_fingerprint(input_stream: Any) -> Optional[str]:
+    """
+    Computes fingerprint of input stream. Only files opened for reading can be fingerprinted
+    :param input_stream: input stream of graph
+    :return: string with path, modification time, size and current position of file or None
+    """
+    if not isinstance(input_stream, io.TextIOWrapper) or not os.path.isfile(input_stream.name):
+        return None
+    stat = os.stat(input_stream.name)
+    return "{}:{}:{}:{}".format(os.path.abspath(input_stream.name), stat.st_mtime_ns,
+                                stat.st_size, input_stream.tell())
+
+
+def stable_repr(value: Any) -> Optional[str]:
+    """
+    Returns representation of value, which is the same in every process
+    :param value: value to represent
+    :return: repr of value or None if it contains a memory address (e.g. default repr of an object)
+    """
+    if isinstance(value, (set, frozenset)):
+        # order of set items depends on hash seed of the process
+        items = [stable_repr(item) for item in value]
+        if None in items:
+            return None
+        return repr(sorted(items))
+    representation = repr(value)
+    if ' at 0x' in representation:
+        return None
+    return representation
+
+
+def unwrap_callable(function: Callable) -> Callable:
+    """
+    Returns python function wrapped by decorators like functools.lru_cache or numba.njit
+    :param function: function or its wrapper
+    :return: innermost wrapped function
+    """
+    while True:
+        wrapped = getattr(function, '__wrapped__', None) or getattr(function, 'py_func', None)
+        if wrapped is None:
+            return function
+        function = wrapped
+
+
+def callable_fingerprint(function: Callable, visited: set = None) -> Optional[bytes]:
+    """
+    Hashes user function: its bytecode, constants, values captured by closure and
+    values of global names it refers to (python functions are hashed recursively, other values by repr).
+    Wrappers (functools.lru_cache, numba dispatchers) are hashed by the python function they wrap
+    :param function: mapper, reducer or folder function
+    :param visited: set of already hashed functions (used in recursive calls)
+    :return: bytes, hash of function or None if some value has no stable representation
+    """
+    function = unwrap_callable(function)
+    if visited is None:
+        visited = set()
+    visited.add(function)
+    hasher = hashlib.blake2b(digest_size=16)
+    code = getattr(function, '__code__', None)
+    if code is None:
+        representation = stable_repr(function)
+        if representation is None:
+            return None
+        hasher.update(representation.encode())
+        return hasher.digest()
+
+    referred_names = []
+
+    def update_code(code_object: CodeType) -> None:
+        hasher.update(code_object.co_code)
+        referred_names.extend(code_object.co_names)
+        for const in code_object.co_consts:
+            if isinstance(const, CodeType):
+                update_code(const)
+            else:
+                hasher.update(repr(const).encode())
+
+    def update_value(value: Any) -> bool:
+        if callable(value) and not isinstance(value, type):
+            value = unwrap_callable(value)
+            if value in visited:
+                return True
+            value_fingerprint = callable_fingerprint(value, visited)
+            if value_fingerprint is None:
+                return False
+            hasher.update(value_fingerprint)
+            return True
+        representation = stable_repr(value)
+        if representation is None:
+            return False
+        hasher.update(representation.encode())
+        return True
+
+    update_code(code)
+    for cell in function.__closure__ or ():
+        try:
+            value = cell.cell_contents
+        except ValueError:  # empty cell
+            hasher.update(b'<empty>')
+            continue
+        if not update_value(value):
+            return None
+    for name in referred_names:
+        if name not in function.__globals__:  # attribute or builtin name
+            continue
+        hasher.update(name.encode())
+        if not update_value(function.__globals__[name]):
+            return None
+    return hasher.digest()
 
 
 def get_generator_from_iterable(iterable_value: Iterable) -> Iterator:
@@ -220,7 +936,17 @@ def get_generator_from_iterable(iterable_value: Iterable) -> Iterator:
         yield record
 
 
-class Sort(object):
+def to_batches(records: Iterable) -> Iterator[List]:
+    """
+    Splits records into micro-batches, which are passed between nodes of Graph
+    :param records: iterable with records
+    :return: returns iterator with lists of BATCH_SIZE records (the last list may be shorter)
+    """
+    records = iter(records)
+    return iter(lambda: list(islice(records, BATCH_SIZE)), [])
+
+
+class Sort(Node):
     """Class represents Sort node in Graph"""
 
     def __init__(self, *columns: str, reverse: bool = False) -> None:
@@ -232,8 +958,63 @@ class Sort(object):
         :return: returns nothing
         """
         self._columns = columns
-        self._data = []
         self._reverse = reverse
+        # C-level key accessor: value of the column for one column, tuple of values for several columns
+        self._key = itemgetter(*columns) if columns else lambda record: ()
+
+    def _spill(self, sorted_pairs: List[Tuple]) -> Any:
+        """
+        Writes sorted run of (key, record) pairs to temporary file
+        :param sorted_pairs: sorted list of (key, record) pairs
+        :return: temporary file with pickled chunks of pairs
+        """
+        run_file = tempfile.TemporaryFile()
+        for begin in range(0, len(sorted_pairs), SPILL_CHUNK_SIZE):
+            pickle.dump(sorted_pairs[begin:begin + SPILL_CHUNK_SIZE], run_file, pickle.HIGHEST_PROTOCOL)
+        run_file.seek(0)
+        return run_file
+
+    def _read_run(self, run_file: Any) -> Iterator:
+        """
+        Reads sorted run of (key, record) pairs from temporary file
+        :param run_file: temporary file written by _spill
+        :return: yield (key, record) pairs
+        """
+        while True:
+            try:
+                yield from pickle.load(run_file)
+            except EOFError:
+                return
+
+    def _sorted_pairs(self, input_generator: Iterator) -> Iterator:
+        """
+        Sorts input by external merge sort: input is split into runs of SORT_BUFFER_SIZE records,
+        every run is sorted in memory and spilled to temporary file, then runs are merged.
+        Key of every record is computed once and kept with the record
+        :param input_generator: input for sort node
+        :return: yield (key, record) pairs in sorted order
+        """
+        run_files = []
+        buffer = []
+        by_key = itemgetter(0)
+        try:
+            for record in input_generator:
+                buffer.append((self._key(record), record))
+                if len(buffer) >= SORT_BUFFER_SIZE:
+                    buffer.sort(key=by_key, reverse=self._reverse)
+                    run_files.append(self._spill(buffer))
+                    buffer = []
+            buffer.sort(key=by_key, reverse=self._reverse)
+
+            if not run_files:
+                yield from buffer
+            else:
+                runs = [self._read_run(run_file) for run_file in run_files]
+                runs.append(buffer)
+                yield from heapq.merge(*runs, key=by_key, reverse=self._reverse)
+        finally:
+            for run_file in run_files:
+                run_file.close()
 
     def run(self, input_generator: Iterator) -> Iterator:
         """
@@ -241,18 +1022,19 @@ class Sort(object):
         :param input_generator: input for sort node
         :return: returns generator, result of sort
         """
-        for record in input_generator:
-            self._data.append(record)
-        self._data.sort(key=lambda record: tuple(record[column] for column in self._columns), reverse=self._reverse)
-
-        # print(self._data)
-        for record in self._data:
+        for _, record in self._sorted_pairs(input_generator):
             yield record
 
-        self._data = []
+    def fingerprint(self, kwargs: Dict) -> Optional[bytes]:
+        """
+        Returns fingerprint of sort node
+        :param kwargs: dict of all input arguments for graph running
+        :return: bytes, representation of sort columns and order
+        """
+        return repr((self._columns, self._reverse)).encode()
 
 
-class Fold(object):
+class Fold(Node):
     """Class represents Fold node in Graph"""
 
     def __init__(self, folder: Callable, initial_state: Dict) -> None:
@@ -264,20 +1046,51 @@ class Fold(object):
         """
         self._folder = folder
         self._initial_state = initial_state
+        self._primitive = getattr(folder, '_fold_primitive', None)
 
     def run(self, input_generator: Iterator) -> Iterator:
         """
-        Runs Fold node
+        Runs Fold node over records through micro-batches
         :param input_generator: input for fold node
-        :return: returns generator, result of application folder function
+        :return: returns generator with one record, the final state
+        """
+        return chain.from_iterable(self.batched_run(to_batches(input_generator)))
+
+    def batched_run(self, input_batches: Iterator[List]) -> Iterator[List]:
+        """
+        Runs Fold node over micro-batches of records
+        :param input_batches: input for fold node, lists of records
+        :return: returns generator with one list, which contains the final state
+        """
+        # Folder may change state in place, so every run starts from a fresh copy of initial state
+        state = copy.deepcopy(self._initial_state)
+        if self._primitive is not None:
+            kind, column = self._primitive
+            aggregate, combine = FOLD_PRIMITIVES[kind], FOLD_COMBINERS[kind]
+            for batch in input_batches:
+                state[column] = combine(state[column], aggregate(batch, column))
+            yield [state]
+            return
+        folder = self._folder
+        for batch in input_batches:
+            for record in batch:
+                state = folder(state, record)
+        yield [state]
+
+    def fingerprint(self, kwargs: Dict) -> Optional[bytes]:
+        """
+        Returns fingerprint of fold node
+        :param kwargs: dict of all input arguments for graph running
+        :return: bytes, hash of folder function and initial state or None if it can not be computed
         """
-        state = self._initial_state
-        for record in input_generator:
-            state = self._folder(state, record)
-        yield state
+        folder_fingerprint = callable_fingerprint(self._folder)
+        initial_state = stable_repr(self._initial_state)
+        if folder_fingerprint is None or initial_state is None:
+            return None
+        return folder_fingerprint + initial_state.encode()
 
 
-class Reduce(object):
+class Reduce(Node):
     """Class represents Reduce node in Graph"""
 
     def __init__(self, reducer: Callable, key: Union[str, Tuple[str, str]]) -> None:
@@ -289,9 +1102,10 @@ class Reduce(object):
         """
         self._reducer = reducer
         if isinstance(key, str):
-            self._key = [key]
+            self._key = (key,)
         else:
-            self._key = key
+            self._key = tuple(key)
+        self._key_fn = itemgetter(*self._key)
 
     def run(self, input_generator: Iterable) -> Iterator:
         """
@@ -299,12 +1113,46 @@ class Reduce(object):
         :param input_generator: input for reduce node
         :return: returns generator, result of application reducer function
         """
-        for _, group in groupby(input_generator,
-                                key=lambda record: tuple(record[column] for column in self._key)):
+        for _, group in groupby(input_generator, key=self._key_fn):
             yield from self._reducer(group)
 
+    def fingerprint(self, kwargs: Dict) -> Optional[bytes]:
+        """
+        Returns fingerprint of reduce node
+        :param kwargs: dict of all input arguments for graph running
+        :return: bytes, hash of reducer function and key or None if it can not be computed
+        """
+        reducer_fingerprint = callable_fingerprint(self._reducer)
+        if reducer_fingerprint is None:
+            return None
+        return reducer_fingerprint + repr(self._key).encode()
+
+
+class SortedGroupBy(Node):
+    """Class represents Sort node and Reduce node by the same columns fused into one node of Graph execution plan"""
+
+    def __init__(self, sort_node: Sort, reduce_node: Reduce) -> None:
+        """
+        Constructs a new 'SortedGroupBy' object
+        :param sort_node: Sort node
+        :param reduce_node: Reduce node with key equal to columns of sort node
+        :return: returns nothing
+        """
+        self._sort_node = sort_node
+        self._reducer = reduce_node._reducer
+
+    def run(self, input_generator: Iterator) -> Iterator:
+        """
+        Runs fused node. Groups are built from keys computed by sort, so key of every record
+        is extracted only once
+        :param input_generator: input for sort node
+        :return: returns generator, result of application reducer function
+        """
+        for _, group in groupby(self._sort_node._sorted_pairs(input_generator), key=itemgetter(0)):
+            yield from self._reducer(map(itemgetter(1), group))
+
 
-class Join(object):
+class Join(Node):
     """Class represents Join node in Graph"""
 
     def __init__(self, on: Graph, strategy: str, key: Union[str, Tuple[str, str]] = None) -> None:
@@ -328,19 +1176,26 @@ class Join(object):
         else:
             self._key = None
         self._on = on
-        self._keys_with_common_name = []
+        self._keys_with_common_name = frozenset()
         self._left_table = None
         self._right_table = None
-        self._right_table_keys = []
-        self._left_table_keys = []
-
-    def _join_reducer(self, records: Iterable) -> Iterator:
+        self._right_table_keys = None
+        self._left_table_keys = None
+        self._left_rename = {}
+        self._right_rename = {}
+        self._left_nulls = {}
+        self._right_nulls = {}
+
+    def fingerprint(self, kwargs: Dict) -> Optional[bytes]:
         """
-        Reducer for _join function
-        :param records: records in group
-        :return: yiels records from one group
+        Returns fingerprint of join node
+        :param kwargs: dict of all input arguments for graph running
+        :return: bytes, fingerprint of right graph with strategy and key or None if it can not be computed
         """
-        yield records
+        on_fingerprint = self._on._fingerprint(kwargs)
+        if on_fingerprint is None:
+            return None
+        return (on_fingerprint + repr((self._strategy, self._key))).encode()
 
     def _stop_join_iteration_condition(self, left_table_part: Iterable, right_table_part: Iterable) -> bool:
         """
@@ -358,26 +1213,25 @@ class Join(object):
         else:
             return len(left_table_part) == 0 and len(right_table_part) == 0
 
+    def _rename_record(self, record: Dict, rename: Dict) -> Dict:
+        """
+        Builds new record with renamed columns
+        :param record: record of left or right table
+        :param rename: map from column names to new column names (columns not in map keep their names)
+        :return: new record
+        """
+        return {rename.get(column, column): value for column, value in record.items()}
+
     def _cartesian_product_left_non_empty_right_empty(self, left_table_part: Iterable) -> Iterator:
         """
         Yield records that are rows in cartesian product of non-empty left and empty right tables.
         :param left_table_part: list with dicts of left table part
         :return: yield records that are rows in cartesian product
         """
-        new_record_right = {}
-        for column_name_right in self._right_table_keys:
-            if column_name_right in self._keys_with_common_name:
-                new_record_right.update({column_name_right + '_right': None})
-            else:
-                new_record_right.update({column_name_right: None})
+        right_nulls = self._right_nulls
         for record_left in left_table_part:
-            new_record = {}
-            for column_name_left in record_left:
-                if column_name_left in self._keys_with_common_name:
-                    new_record.update({column_name_left + '_left': record_left[column_name_left]})
-                else:
-                    new_record.update({column_name_left: record_left[column_name_left]})
-            new_record.update(new_record_right)
+            new_record = self._rename_record(record_left, self._left_rename)
+            new_record.update(right_nulls)
             yield new_record
 
     def _cartesian_product_left_empty_right_non_empty(self, right_table_part: Iterable) -> Iterator:
@@ -386,20 +1240,10 @@ class Join(object):
         :param right_table_part: list with dicts of right table part
         :return: yield records that are rows in cartesian product
         """
-        new_record_left = {}
-        for column_name_left in self._left_table_keys:
-            if column_name_left in self._keys_with_common_name:
-                new_record_left.update({column_name_left + '_left': None})
-            else:
-                new_record_left.update({column_name_left: None})
+        left_nulls = self._left_nulls
         for record_right in right_table_part:
-            new_record = {}
-            for column_name_right in record_right:
-                if column_name_right in self._keys_with_common_name:
-                    new_record.update({column_name_right + '_right': record_right[column_name_right]})
-                else:
-                    new_record.update({column_name_right: record_right[column_name_right]})
-                new_record.update(new_record_left)
+            new_record = self._rename_record(record_right, self._right_rename)
+            new_record.update(left_nulls)
             yield new_record
 
     def _cartesian_product_left_non_empty_right_non_empty(self, left_table_part: Iterable,
@@ -410,50 +1254,132 @@ class Join(object):
         :param right_table_part: list with dicts of right table part
         :return: yield records that are rows in cartesian product
         """
+        renamed_right_part = [self._rename_record(record_right, self._right_rename)
+                              for record_right in right_table_part]
         for record_left in left_table_part:
-            new_record_left = {}
-            for column_name_left in record_left:  # Creates new record from record_left with new keys
-                if column_name_left in self._keys_with_common_name:
-                    new_record_left.update({column_name_left + '_left': record_left[column_name_left]})
-                else:
-                    new_record_left.update({column_name_left: record_left[column_name_left]})
-            new_record = {}
-            new_record.update(new_record_left)
-            for record_right in right_table_part:
-                for column_name_right in record_right:
-                    if column_name_right in self._keys_with_common_name:
-                        new_record.update({column_name_right + '_right': record_right[column_name_right]})
-                    else:
-                        new_record.update({column_name_right: record_right[column_name_right]})
-                yield new_record
-                new_record = {}
-                new_record.update(new_record_left)
+            renamed_left = self._rename_record(record_left, self._left_rename)
+            for renamed_right in renamed_right_part:
+                yield {**renamed_left, **renamed_right}
 
-    def _get_next_table_part(self, table_groups: Iterator) -> Iterable:
+    def _sorted_table_parts(self, table: Iterable, key: Callable) -> Iterator[List[Dict]]:
+        """
+        Sorts table by key and yields its parts with the same key. Keys of sorted table are extracted once,
+        bounds of every part are found by binary search over them and the part is a slice of sorted list,
+        so records are not pulled one by one through an iterator
+        :param table: iterable with dicts of table
+        :param key: function, which returns key of record
+        :return: yield lists with dicts of table parts
+        """
+        sorted_table = sorted(table, key=key)
+        keys = list(map(key, sorted_table))
+        start, size = 0, len(keys)
+        while start < size:
+            end = bisect_right(keys, keys[start], start)
+            yield sorted_table[start:end]
+            start = end
+
+    def _get_next_table_part(self, table_parts: Iterator) -> Iterable:
         """
         Make next for iterator with table parts and returns list that is new table part.
-        If next(iterator) is None returns empty list
-        :param table_groups: iterator with table groups
+        If iterator is exhausted returns empty list
+        :param table_parts: iterator with lists of table parts
         :return: list that is next table part
         """
-        next_group = next(table_groups, None)
-        if next_group is None:
-            table_part = []
+        return next(table_parts, [])
+
+    def _buffer_build_table(self, table: Iterator) -> Tuple[List[Dict], bool]:
+        """
+        Reads records of build table of hash join while their estimated size (by sys.getsizeof)
+        does not exceed HASH_JOIN_MEMORY_LIMIT
+        :param table: build table
+        :return: tuple of list with read records and flag, True if the whole table was read
+        """
+        buffered = []
+        buffered_size = 0
+        for record in table:
+            buffered.append(record)
+            buffered_size += sys.getsizeof(record)
+            if buffered_size > HASH_JOIN_MEMORY_LIMIT:
+                return buffered, False
+        return buffered, True
+
+    def _build_hash_index(self, build_table: List[Dict], build_on_left: bool) -> Dict:
+        """
+        Builds hash index of build table of hash join
+        :param build_table: list with all records of build table
+        :param build_on_left: True if build table is left table
+        :return: dict from join key value to list of renamed records of build table with this value
+        """
+        if build_on_left:
+            build_key, build_rename = self._key[0], self._left_rename
+        else:
+            build_key, build_rename = self._key[1], self._right_rename
+        index = defaultdict(list)
+        for record in build_table:
+            index[record[build_key]].append(self._rename_record(record, build_rename))
+        return index
+
+    def _hash_join(self, index: Dict, build_on_left: bool) -> Iterator:
+        """
+        Runs hash join (inner, left or right): streams probe table (left table for inner and left joins,
+        right table for right join) through hash index of build table. Rows are emitted in order
+        of probe table, not sorted by key as sort-merge join emits them. Probe record with unhashable
+        key value has no match: it is dropped by inner join and emitted with nulls by left and right joins
+        :param index: hash index of build table built by _build_hash_index
+        :param build_on_left: True if build table is left table
+        :return: yield records of joined table
+        """
+        if build_on_left:
+            probe_key, probe_rename = self._key[1], self._right_rename
+            probe_table, probe_nulls = self._right_table, self._left_nulls
         else:
-            table_part = list(next_group)
-        return table_part
+            probe_key, probe_rename = self._key[0], self._left_rename
+            probe_table, probe_nulls = self._left_table, self._right_nulls
+
+        keep_unmatched = self._strategy != 'inner'
+        for record in probe_table:
+            renamed_probe = self._rename_record(record, probe_rename)
+            try:
+                matches = index.get(record[probe_key])
+            except TypeError:  # unhashable key value is not equal to any key of hashable build table
+                matches = None
+            if matches:
+                for renamed_build in matches:
+                    if build_on_left:
+                        yield {**renamed_build, **renamed_probe}
+                    else:
+                        yield {**renamed_probe, **renamed_build}
+            elif keep_unmatched:
+                renamed_probe.update(probe_nulls)
+                yield renamed_probe
 
     def _join(self) -> None:
         """
-        Runs join (inner, left, right or full)
+        Runs join (inner, left, right or full). Inner, left and right joins are run as hash join
+        if build table (right for inner and left joins, left for right join) fits in memory,
+        otherwise (and for full join) sort-merge join is used
         :return: returns nothing
         """
-        sort_node_left = Sort(self._key[0])
-        sort_node_right = Sort(self._key[1])
-        reduce_node_left = Reduce(self._join_reducer, self._key[0])
-        reduce_node_right = Reduce(self._join_reducer, self._key[1])
-        left_table_groups = reduce_node_left.run(sort_node_left.run(self._left_table))
-        right_table_groups = reduce_node_right.run(sort_node_right.run(self._right_table))
+        if self._strategy in ('inner', 'left', 'right'):
+            build_on_left = self._strategy == 'right'
+            build_table, fits = self._buffer_build_table(self._left_table if build_on_left else self._right_table)
+            if fits:
+                try:
+                    index = self._build_hash_index(build_table, build_on_left)
+                except TypeError:  # unhashable key values, only sort-merge join is possible
+                    pass
+                else:
+                    yield from self._hash_join(index, build_on_left)
+                    return
+            if build_on_left:
+                self._left_table = chain(build_table, self._left_table)
+            else:
+                self._right_table = chain(build_table, self._right_table)
+
+        left_key = itemgetter(self._key[0])
+        right_key = itemgetter(self._key[1])
+        left_table_groups = self._sorted_table_parts(self._left_table, left_key)
+        right_table_groups = self._sorted_table_parts(self._right_table, right_key)
         left_table_part = self._get_next_table_part(left_table_groups)
         right_table_part = self._get_next_table_part(right_table_groups)
 
@@ -493,61 +1419,57 @@ class Join(object):
 
     def _cross_join(self):
         """
-        Runs cross join
+        Runs cross join. Right table is broadcast: it is materialized (and renamed) once, left table
+        is streamed through it, so a join with a single-row table (a scalar) costs one pass over left table
         :return: yield generator, result of join
         """
-        left_table = list(self._left_table)
-        right_table = list(self._right_table)
+        yield from self._cartesian_product_left_non_empty_right_non_empty(self._left_table,
+                                                                          list(self._right_table))
 
-        for record_left in left_table:
-            new_record_left = {}
-            for column_name_left in self._left_table_keys:
-                if column_name_left in self._keys_with_common_name:
-                    new_record_left.update({column_name_left + '_left': record_left[column_name_left]})
-                else:
-                    new_record_left.update({column_name_left: record_left[column_name_left]})
-            new_record = {}
-            new_record.update(new_record_left)
-            for record_right in right_table:
-                for column_name_right in record_right:
-                    if column_name_right in self._keys_with_common_name:
-                        new_record.update(
-                            {column_name_right + '_right': record_right[column_name_right]})
-                    else:
-                        new_record.update({column_name_right: record_right[column_name_right]})
-                yield new_record
-                new_record = {}
-                new_record.update(new_record_left)
+    def run(self, left_table: Iterator) -> Iterator:
+        """
+        Runs Join node. Output of right graph is taken immediately, so the right graph may drop it
+        before the result of join is consumed
+        :param left_table: input for join node
+        :return: returns generator, result of selected join function
+        """
+        if self._on._output_is_cached():
+            right_table = self._on.get_generator_from_output_cache()
+        else:
+            right_table = self._on._output
+        return self._run(left_table, right_table)
 
-    def run(self, left_table):
+    def _run(self, left_table: Iterator, right_table: Iterator) -> Iterator:
         """
         Runs Join node
         :param left_table: input for join node
+        :param right_table: output of right graph
         :return: yield from selected join function
         """
-
-        if self._on._count_of_calls == 1:
-            self._right_table = self._on._output
-        else:
-            self._right_table = self._on.get_generator_from_output_cache()
-
-        self._on._remained_count_of_calls -= 1
-
         self._left_table = left_table
+        self._right_table = right_table
 
-        first_elem_right_table = next(self._right_table, None)
-        first_elem_left_table = next(self._left_table, None)
-
-        if first_elem_right_table is None or first_elem_left_table is None:
+        try:
+            first_elem_right_table = next(self._right_table)
+            first_elem_left_table = next(self._left_table)
+        except StopIteration:
             return
 
-        self._left_table = chain([first_elem_left_table], self._left_table)
-        self._right_table = chain([first_elem_right_table], self._right_table)
-
-        self._left_table_keys = set(first_elem_left_table.keys())
-        self._right_table_keys = set(first_elem_right_table.keys())
-
-        self._keys_with_common_name = self._left_table_keys & self._right_table_keys
+        # Neither table is seekable, so peeked records are put back in front of them
+        self._left_table = chain((first_elem_left_table,), self._left_table)
+        self._right_table = chain((first_elem_right_table,), self._right_table)
+
+        left_table_keys = frozenset(first_elem_left_table)
+        right_table_keys = frozenset(first_elem_right_table)
+        if left_table_keys != self._left_table_keys or right_table_keys != self._right_table_keys:
+            # Schema differs from the previous run, so rename maps are rebuilt
+            self._left_table_keys = left_table_keys
+            self._right_table_keys = right_table_keys
+            self._keys_with_common_name = left_table_keys & right_table_keys
+            self._left_rename = {column: column + '_left' for column in self._keys_with_common_name}
+            self._right_rename = {column: column + '_right' for column in self._keys_with_common_name}
+            self._left_nulls = dict.fromkeys(self._left_rename.get(column, column) for column in left_table_keys)
+            self._right_nulls = dict.fromkeys(self._right_rename.get(column, column) for column in right_table_keys)
         strategies_names_require_keys = ['inner', 'left', 'right', 'full']
         try:
             if self._strategy in strategies_names_require_keys:
@@ -563,7 +1485,6 @@ class Join(object):
                 raise ValueError("Incorrect strategy of join {}. Possible variants: left, right, inner,"
                                  " cross, full".format(self._strategy))
         except Exception as e:
+            # output of failed join is incomplete, so the error must reach the caller
             logger.exception(e)
-
-        if self._on._remained_count_of_calls == 0:
-            self._on._cache = []
+            raise
@@ -0,0 +1,18 @@
+from typing import List
+
+# Characters, which separate words in texts of the solved tasks
+DELIMITERS = ' .?!:,-";$%^&*()@#~<>/\n[]'
+
+# Every delimiter is translated to space, so words are split by str.split in one C-level pass
+_DELIMITERS_TO_SPACES = str.maketrans(DELIMITERS, ' ' * len(DELIMITERS))
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits text into lowercased words: maximal runs of characters, which are not delimiters.
+    Translation, lowercasing and splitting are single passes over the whole text, which is faster
+    than matching a regular expression word by word
+    :param text: text with words
+    :return: list with words in order of occurrence
+    """
+    return text.translate(_DELIMITERS_TO_SPACES).lower().split()
@@ -15,6 +15,7 @@ setup(
     author="Masha Eidlina",
     author_email="mashaeidlina@yandex.ru",
     requires=['pytest'],
+    extras_require={'orjson': ['orjson'], 'numba': ['numba']},
     # requires=['logging', 'json', 'itertools', 'typing', 'io'],
     packages=packages,
     packages_dir=packages
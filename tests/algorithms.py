@@ -1,27 +1,99 @@
 import graph
-import re
-from typing import Iterable, Dict, Iterator
-from math import log, acos, sin, cos, radians
+from graph.src.textutils import tokenize
+from typing import Iterable, Dict, Iterator, Tuple, Callable, List
+from heapq import nlargest
 from collections import Counter
-import time
+from math import log, asin, sin, cos, sqrt
+from datetime import datetime, timezone
+from functools import lru_cache
+from operator import itemgetter
+from sys import intern
+
+try:
+    from numba import njit
+except ImportError:  # optional dependency, haversine kernel runs as plain python
+    njit = None
 
 
 def extract_words(text: str) -> Iterator:
     """
-    Extracts words from text
+    Extracts words from text. Words are interned: all occurrences of a word in the tokenized stream
+    (and in the columns of its cache) refer to one string object, which lowers peak memory of
+    the tasks, which keep words in sorted or cached tables. Interned strings are released
+    when they are not referenced any more
     :param text: Text with words
     :return: generator with extracted words
     """
-    delimiters = [
-        ' ', '.', '?', '!', ':', ',', '-', '"',
-        ';', '$', '%', '^', '&', '*', '(', ')',
-        '@', '#', '~', '<', '>', '/', '\n',
-        '[', ']'
-    ]
-    regex_pattern = '|'.join(map(re.escape, delimiters))
-    for word in re.split(regex_pattern, text):
-        if word:
-            yield word.lower().strip()
+    yield from map(intern, tokenize(text))
+
+
+def _top_k(records: Iterable, k: int, score: Callable, columns: Tuple[str, ...]) -> List[Tuple[float, Tuple]]:
+    """
+    Selects k records with the largest scores by a bounded heap. Score of every record is computed once,
+    records with equal scores keep their order. Heap keeps only score and values of needed columns,
+    not records themselves
+    :param records: records to select from
+    :param k: number of records to select
+    :param score: function, which returns score of record
+    :param columns: names of columns to keep (at least two)
+    :return: list of (score, tuple with values of columns) pairs in order of decreasing score
+    """
+    get_values = itemgetter(*columns)
+    # Negative index breaks ties in favour of earlier records, so values are never compared
+    scored_records = ((score(record), -index, get_values(record)) for index, record in enumerate(records))
+    return [(record_score, values) for record_score, _, values in nlargest(k, scored_records)]
+
+
+def _haversine(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """
+    Calculates great-circle distance between two points on the Earth by haversine formula
+    :param lon1: longitude of first point in degrees
+    :param lat1: latitude of first point in degrees
+    :param lon2: longitude of second point in degrees
+    :param lat2: latitude of second point in degrees
+    :return: distance in meters
+    """
+    # Only differences of angles and cosines of latitudes are needed, so every angle is converted once
+    sin_half_dlat = sin((lat2 - lat1) * 0.008726646259971648)  # pi / 360: degrees to radians, halved
+    sin_half_dlon = sin((lon2 - lon1) * 0.008726646259971648)
+    a = (sin_half_dlat * sin_half_dlat
+         + cos(lat1 * 0.017453292519943295) * cos(lat2 * 0.017453292519943295) * sin_half_dlon * sin_half_dlon)
+    return 12742604.0 * asin(sqrt(a))  # diameter of the Earth
+
+
+if njit is not None:
+    _haversine = njit(cache=True, fastmath=True)(_haversine)
+    _haversine(0.0, 0.0, 0.0, 0.0)  # compile at import, not on the first record
+
+
+_WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+
+@lru_cache(maxsize=4096)
+def _day_info(year: int, month: int, day: int) -> Tuple[int, float]:
+    """
+    Computes weekday and start of day. Results are cached, because a lot of records have the same date
+    :param year: year
+    :param month: month
+    :param day: day of month
+    :return: tuple with weekday (0 is Monday) and unix time of midnight (UTC)
+    """
+    midnight = datetime(year, month, day, tzinfo=timezone.utc)
+    return midnight.weekday(), midnight.timestamp()
+
+
+def _parse_time(time_str: str) -> Tuple[int, int, float]:
+    """
+    Parses time in format YYYYmmddTHHMMSS.ffffff (fractional part of seconds may be omitted).
+    Format is fixed, so fields are sliced directly
+    :param time_str: time (UTC)
+    :return: tuple with weekday (0 is Monday), hour and unix time
+    """
+    weekday, day_epoch = _day_info(int(time_str[0:4]), int(time_str[4:6]), int(time_str[6:8]))
+    hour = int(time_str[9:11])
+    epoch = (day_epoch + hour * 3600 + int(time_str[11:13]) * 60 + int(time_str[13:15])
+             + float(time_str[15:] or '0'))
+    return weekday, hour, epoch
 
 
 def build_word_count_graph(input_stream: str, text_column: str = 'text', count_column: str = 'count') -> graph.Graph:
@@ -42,37 +114,46 @@ def build_word_count_graph(input_stream: str, text_column: str = 'text', count_c
     :return: returns 'Graph' object
     """
 
-    def emit_words(record: Dict) -> Iterator:
+    @graph.batched_mapper
+    def emit_words(records: List[Dict]) -> Iterator:
         """
-        Mapper. Builds dicts with 2 fields: count_column with value = 1 and text_column
-        with word from record (word is extracted by extract_words function)
+        Batched mapper. Counts words in a micro-batch of records: texts of the batch are joined
+        by space (which is a delimiter) and tokenized at once. Builds dicts with 2 fields: count_column
+        with number of occurrences of word in the batch and text_column with word
 
-        From one record with string this function yields lots of dicts,
-        which number is equal to number of words in a string
+        :param records: micro-batch of records with texts in text_column
+        :return: yield dicts with 2 fields, one for every distinct word of the batch
+        """
+        words = Counter(tokenize(' '.join(record[text_column] for record in records)))
+        for word, count in words.items():
+            yield {count_column: count, text_column: word}
 
-        :param record: record with one word in text_column
-        :return: yield dicts with 2 fields
+    def count_words(state: Dict, record: Dict) -> Dict:
         """
-        for word in extract_words(record[text_column]):
-            yield {count_column: 1, text_column: word}
+        Folder. Counts words in a dict, so words are not sorted to be grouped.
+        Final state of fold stage is dict with words as keys and their numbers as values
+        :param state: current state for folder
+        :param record: record with word in text_column and its number in count_column
+        :return: dict with new state
+        """
+        word = record[text_column]
+        state[word] = state.get(word, 0) + record[count_column]
+        return state
 
-    def collect_counts(records: Iterable) -> Iterator:
+    def emit_counts(state: Dict) -> Iterator:
         """
-        Reducer. Counts words
-        :param records: an iterable with dicts. All dicts have equal value
-        of field text_column (they represent the same word)
-        :return: yield dict with word and number of this word
+        Mapper. Builds dicts with word and number of this word from the state of fold stage
+        :param state: dict with words as keys and their numbers as values
+        :return: yield dicts with 2 fields
         """
-        count_records = 0
-        for record in records:
-            count_records += 1
-        yield {count_column: count_records, text_column: record[text_column]}
+        for word, count in state.items():
+            yield {count_column: count, text_column: word}
 
     my_graph = graph.Graph(source=input_stream)
     my_graph.map(emit_words)
-    my_graph.sort(text_column)
-    my_graph.reduce(collect_counts, key=text_column)
-    my_graph.sort(count_column)
+    my_graph.fold(count_words, {})
+    my_graph.map(emit_counts)
+    my_graph.sort(count_column, text_column)
     return my_graph
 
 
@@ -112,6 +193,7 @@ def build_inverted_index_graph(input_stream: str, doc_column: str = 'doc_id', te
         for word in extract_words(record[text_column]):
             yield {doc_column: record[doc_column], text_column: word}
 
+    @graph.fold_primitive('count', column='docs_count')
     def count_records(state: Dict, _) -> Dict:
         """
         Folder. Counts all records. Final state of fold stage is
@@ -153,17 +235,20 @@ def build_inverted_index_graph(input_stream: str, doc_column: str = 'doc_id', te
         :param records: selected records
         :return: yield record with tf value
         """
-        word_count = Counter()
-
+        word_count = {}
+        total = 0
         for record in records:
-            word_count[record[text_column]] += 1
+            word = record[text_column]
+            word_count[word] = word_count.get(word, 0) + 1
+            total += 1
 
-        total = sum(word_count.values())
+        doc_id = record[doc_column]
+        inverse_total = 1.0 / total
         for w, count in word_count.items():
             yield {
-                doc_column: record[doc_column],
+                doc_column: doc_id,
                 text_column: w,
-                'tf': count / total
+                'tf': count * inverse_total
             }
 
     def invert_index(records: Iterable) -> Iterator:
@@ -172,27 +257,15 @@ def build_inverted_index_graph(input_stream: str, doc_column: str = 'doc_id', te
         :param records: selected records
         :return: yield records with tf-idf value
         """
-        new_records = []
-        for record in records:
-            tf_idf = record['tf'] * record['idf']
-            record.update({'tf_idf': tf_idf})
-            new_records.append(record)
-        new_records.sort(key=lambda row: row['tf_idf'], reverse=True)
-        counter = 0
-        for record in new_records:
-            if counter > 2:
-                break
-            yield {
-                text_column: record[text_column + "_left"],
-                doc_column: record[doc_column],
-                'tf_idf': record['tf_idf']
-            }
-            counter += 1
+        top = _top_k(records, 3, lambda row: row['tf'] * row['idf'], (text_column + "_left", doc_column))
+        for tf_idf, (word, doc_id) in top:
+            yield {text_column: word, doc_column: doc_id, 'tf_idf': tf_idf}
 
     input_graph = graph.Graph(source=input_stream)
 
     split_word_graph = graph.Graph(source=input_graph)
     split_word_graph.map(emit_words)
+    split_word_graph.cache()
 
     count_docs_graph = graph.Graph(source=input_graph)
     count_docs_graph.fold(count_records, {'docs_count': 0})
@@ -235,39 +308,54 @@ def build_pmi_graph(input_stream: str, doc_column: str = 'doc_id', text_column:
     :param text_column: name of column with text
     :return: returns 'Graph' object
     """
+    def split_words(record):
+        """
+        Mapper. Builds dict with 3 fields: doc_column, 'words' with list of words of the record longer than
+        four characters (words are extracted by extract_words function) and 'total_words' with number of all
+        words of the record. Frequencies are relative to all words, but only long words can get to the result,
+        so short words are dropped here and do not reach sorts and joins
+        :param record: record with text in text_column
+        :return: yield dict with 3 fields
+        """
+        words = list(extract_words(record[text_column]))
+        yield {doc_column: record[doc_column], 'words': [word for word in words if len(word) > 4],
+               'total_words': len(words)}
+
     def emit_words(record):
         """
-        Mapper. Builds dicts with 2 fields: count_column with value = 1 and text_column
-        with word from record (word is extracted by extract_words function)
-        :param record: record with one word in text_column
-        :return: yield dicts with 2 fields
-        From one record with string this function yields lots of dicts,
-        which number is equal to number of words in a string
+        Mapper. Builds dicts with 1 field: text_column with word from record
+        :param record: record with list of words in 'words'
+        :return: yield dicts with 1 field
+        From one record this function yields lots of dicts,
+        which number is equal to number of words in the list
         """
-        for word in extract_words(record[text_column]):
-            yield {doc_column: record[doc_column], text_column: word}
+        for word in record['words']:
+            yield {text_column: word}
 
-    def count_records(state: Dict, _) -> Dict:
+    @graph.fold_primitive('sum', column='total_words')
+    def count_words_in_all_documents(state: Dict, record: Dict) -> Dict:
         """
-        Folder. Counts all records. Final state of fold stage is
-        dict with value of 'docs_count' = number of documents
+        Folder. Counts all words. Final state of fold stage is
+        dict with value of 'total_words' = number of words in all documents
         :param state: current state for folder
-        :param _: unused parameter with record
+        :param record: record with number of words in 'total_words'
         :return: returns dict with new state
         """
-        state['docs_count'] += 1
+        state['total_words'] += record['total_words']
         return state
 
     def count_words(records: Iterable) -> Iterator:
         """
-        Reducer. Counts words in all documents
+        Reducer. Counts words in all documents. Words, which occur only once, can not occur twice
+        in a document, so they are not needed for the join with frequencies in documents
         :param records: records with the same word
-        :return: yield record with count of word
+        :return: yield record with count of word if it occurs at least twice
         """
         rows_count = 0
         for record in records:
             rows_count += 1
-        yield {text_column: record[text_column], 'word_count': rows_count}
+        if rows_count >= 2:
+            yield {text_column: record[text_column], 'word_count': rows_count}
 
     def calculate_frequency_of_word_in_document(records: Iterable) -> Iterator:
         """
@@ -276,68 +364,54 @@ def build_pmi_graph(input_stream: str, doc_column: str = 'doc_id', text_column:
         :param records: record with the same doc_id
         :return: yield record with frequency of every word in document
         """
-        word_count = Counter()
+        word_count = {}
+        total = 0
         for record in records:
-            word_count[record[text_column]] += 1
-        total = sum(word_count.values())
+            for word in record['words']:
+                word_count[word] = word_count.get(word, 0) + 1
+            total += record['total_words']
+        doc_id = record[doc_column]
         for word, count in word_count.items():
             if count >= 2:
                 yield {
-                    doc_column: record[doc_column],
+                    doc_column: doc_id,
                     text_column: word,
                     'no': count / total
                 }
 
-    def calculate_frequency_of_word_in_all_documents(record: Dict) -> Iterator:
-        """
-        Mapper. Calculates frequency of word in all documents combined (denominator
-        in pmi formula)
-        :param record: current record
-        :return: yield record with frequency of word in all documents combined
-        """
-        yield {text_column: record[text_column], 'dn': record['word_count'] / record['docs_count']}
-
     def calc_pmi(records: Iterable) -> Iterator:
         """
         Reducer. Calculates pmi index and selects top 10 records by pmi index
         :param records: selected records
         :return: yield record with pmi value
         """
-        new_records = []
-        for record in records:
-            pmi = log(record['no'] / record['dn'])
-            record.update({'pmi': pmi})
-            new_records.append(record)
-        new_records.sort(key=lambda row: row['pmi'], reverse=True)
-        counter = 0
-        for record in new_records:
-            if counter > 9:
-                break
-            yield {
-                text_column: record[text_column + "_left"],
-                doc_column: record[doc_column],
-                'pmi': record['pmi']
-            }
-            counter += 1
+        # Frequency of word in all documents is word_count / total_words, so it is not computed separately.
+        # log is monotonic, so top records by pmi are top records by the ratio under it
+        def ratio(row: Dict) -> float:
+            return row['no'] * row['total_words'] / row['word_count']
+
+        for record_ratio, (word, doc_id) in _top_k(records, 10, ratio, (text_column + "_left", doc_column)):
+            yield {text_column: word, doc_column: doc_id, 'pmi': log(record_ratio)}
 
     split_word_graph = graph.Graph(source=input_stream)
-    split_word_graph.map(emit_words)
+    split_word_graph.map(split_words)
+    split_word_graph.cache()
 
-    count_docs_graph = graph.Graph(source=split_word_graph)
-    count_docs_graph.fold(count_records, {'docs_count': 0})
+    count_all_words_graph = graph.Graph(source=split_word_graph)
+    count_all_words_graph.fold(count_words_in_all_documents, {'total_words': 0})
 
     calc_denominator_graph = graph.Graph(source=split_word_graph)
+    calc_denominator_graph.map(emit_words)
     calc_denominator_graph.sort(text_column)
     calc_denominator_graph.reduce(count_words, key=text_column)
-    calc_denominator_graph.join(count_docs_graph, strategy='cross')
-    calc_denominator_graph.map(calculate_frequency_of_word_in_all_documents)
+    calc_denominator_graph.join(count_all_words_graph, strategy='cross')
 
     calc_nomenator_graph = graph.Graph(source=split_word_graph)
     calc_nomenator_graph.sort(doc_column)
     calc_nomenator_graph.reduce(calculate_frequency_of_word_in_document, key=doc_column)
 
     calc_nomenator_graph.join(calc_denominator_graph, strategy='left', key=text_column)
-    calc_nomenator_graph.sort(doc_column, doc_column)
+    calc_nomenator_graph.sort(doc_column)
     calc_nomenator_graph.reduce(calc_pmi, key=doc_column)
     return calc_nomenator_graph
 
@@ -372,8 +446,6 @@ def build_yandex_maps_graph(input_stream_times: str, input_stream_coords: str) -
         3) generator that produces dicts
     :return: returns 'Graph' object
     """
-    weeks_dict = {0: "Mon", 1: "Tue", 2: "Wed", 3: "Thu", 4: "Fri", 5: "Sat", 6: "Sun"}
-
     def get_week_hour(record: Dict) -> Iterator:
         """
         Mapper. From record in tables with times forms new record with separated weekday and hour.
@@ -386,36 +458,20 @@ def build_yandex_maps_graph(input_stream_times: str, input_stream_coords: str) -
         :return: yield new record with fields:  "weekday", "hour", "spent_time", "edge_id"
         """
 
-        leave_time_str = record["leave_time"]
-        leave_struct_time = time.strptime(leave_time_str[0:15], "%Y%m%dT%H%M%S")
-        weekday = weeks_dict[leave_struct_time.tm_wday]
-        hour = leave_struct_time.tm_hour
-        enter_time_str = record["enter_time"]
-        enter_struct_time = time.strptime(enter_time_str[0:15], "%Y%m%dT%H%M%S")
-        secs_leave = leave_time_str[15:]
-        if len(secs_leave) == 0:
-            secs_leave = 0
-        else:
-            secs_leave = float(secs_leave)
-        secs_enter = enter_time_str[15:]
-        if len(secs_enter) == 0:
-            secs_enter = 0
-        else:
-            secs_enter = float(secs_enter)
-        spent_time = (time.mktime(leave_struct_time) + secs_leave -
-                      time.mktime(enter_struct_time) - secs_enter)
+        leave_weekday, hour, leave_epoch = _parse_time(record["leave_time"])
+        _, _, enter_epoch = _parse_time(record["enter_time"])
         yield {
-            "weekday": weekday,
+            "weekday": _WEEKDAYS[leave_weekday],
             "hour": hour,
-            "spent_time": spent_time,
+            "spent_time": leave_epoch - enter_epoch,
             "edge_id": record["edge_id"]
         }
 
     def get_lengths(record: Dict) -> Iterator:
         """
-        Mapper. From record in tables with coordinates forms new record with length of street,
-        using formula:
-        length = R * arccos(sin(lon1) * sin(lon2) + cos(lon1) * cos(lon2) * cos(lat2 - lat1)),
+        Mapper. From record in table with coordinates forms new record with length of street,
+        using haversine formula:
+        length = 2 * R * arcsin(sqrt(sin^2((lat2 - lat1) / 2) + cos(lat1) * cos(lat2) * sin^2((lon2 - lon1) / 2))),
         where R - Earth radius, lon1, lat1 - longitude and latitude of first coordinate
         (start coordinate), lon2, lat2 - longitude and latitude of second coordinate
         (end coordinate), length - length of street with edge_id in meters.
@@ -427,13 +483,8 @@ def build_yandex_maps_graph(input_stream_times: str, input_stream_coords: str) -
         :param record: record from table with coordinates
         :return: yield new record with fields: "edge_id", "length"
         """
-
-        start_coords = record["start"]
-        end_coords = record["end"]
-        length = 6371302 * acos(sin(radians(start_coords[0])) * sin(radians(end_coords[0]))
-                                + cos(radians(start_coords[0])) * cos(radians(end_coords[0]))
-                                * cos(radians(end_coords[1]) - radians(start_coords[1])))
-        yield {"edge_id": record["edge_id"], "length": length}
+        start, end = record["start"], record["end"]
+        yield {"edge_id": record["edge_id"], "length": _haversine(start[0], start[1], end[0], end[1])}
 
     def get_speeds(record: Dict) -> Iterator:
         """
@@ -450,18 +501,24 @@ def build_yandex_maps_graph(input_stream_times: str, input_stream_coords: str) -
         """
         Forms mew record with average speed (in meters per second) and converts it
         in kilometers per hour.
+        Speeds are summed by Kahan summation, so the average does not depend on the number of records
+        and their order as much as with the naive sum
         :param records: table with equal field "weekday" and "hour"
         :return: yield new record with fields "weekday", "hour" and "speed"
         """
-        sum_speeds = 0
+        sum_speeds = 0.0
+        compensation = 0.0
         counter = 0
         for record in records:
-            sum_speeds += record["speed"]
+            speed = record["speed"] - compensation
+            new_sum = sum_speeds + speed
+            compensation = (new_sum - sum_speeds) - speed
+            sum_speeds = new_sum
             counter += 1
         yield {
             "weekday": record["weekday"],
             "hour": record["hour"],
-            "speed": (18 * sum_speeds) / (5 * counter)
+            "speed": 3.6 * sum_speeds / counter  # m/s to km/h
         }
 
     times_graph = graph.Graph(source=input_stream_times)
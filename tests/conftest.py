@@ -0,0 +1,26 @@
+from tests import algorithms
+import pytest
+
+
+# Graphs of the solved tasks are built once per session: a graph can be run many times,
+# its execution plan is compiled by the first run and reused by the next ones
+
+
+@pytest.fixture(scope='session')
+def word_count_graph():
+    return algorithms.build_word_count_graph('docs')
+
+
+@pytest.fixture(scope='session')
+def inverted_index_graph():
+    return algorithms.build_inverted_index_graph('texts')
+
+
+@pytest.fixture(scope='session')
+def pmi_graph():
+    return algorithms.build_pmi_graph('texts')
+
+
+@pytest.fixture(scope='session')
+def yandex_maps_graph():
+    return algorithms.build_yandex_maps_graph('travel_times', 'lengths')
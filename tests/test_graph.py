@@ -1,78 +1,241 @@
 from tests import algorithms
-from graph import Graph
-from itertools import cycle, islice
+from graph import Graph, batched_mapper, fold_primitive
+from graph.src import graph as graph_module
+from graph.src import textutils
+import io
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+from operator import itemgetter
+import pytest
 from pytest import approx
 from collections import Counter
-
-
-def sorted_eq(tb1, tb2, key):
-    return sorted(tb1, key=lambda x: tuple(x[k] for k in key)) == \
-           sorted(tb2, key=lambda x: tuple(x[k] for k in key))
-
-
-def test_word_count():
+from functools import lru_cache
+from math import isclose
+
+
+YANDEX_MAPS_LENGTHS = (
+    {"start": [37.84870228730142, 55.73853974696249], "end": [37.8490418381989, 55.73832445777953],
+     "edge_id": 8414926848168493057},
+    {"start": [37.524768467992544, 55.88785375468433], "end": [37.52415172755718, 55.88807155843824],
+     "edge_id": 5342768494149337085},
+    {"start": [37.56963176652789, 55.846845586784184], "end": [37.57018438540399, 55.8469259692356],
+     "edge_id": 5123042926973124604},
+    {"start": [37.41463478654623, 55.654487907886505], "end": [37.41442892700434, 55.654839486815035],
+     "edge_id": 5726148664276615162},
+    {"start": [37.584684155881405, 55.78285809606314], "end": [37.58415022864938, 55.78177368734032],
+     "edge_id": 451916977441439743},
+    {"start": [37.736429711803794, 55.62696328852326], "end": [37.736344216391444, 55.626937723718584],
+     "edge_id": 7639557040160407543},
+    {"start": [37.83196756616235, 55.76662947423756], "end": [37.83191015012562, 55.766647034324706],
+     "edge_id": 1293255682152955894},
+)
+
+YANDEX_MAPS_TIMES = (
+    {"leave_time": "20171020T112238.723000",
+     "enter_time": "20171020T112237.427000", "edge_id": 8414926848168493057},
+    {"leave_time": "20171011T145553.040000",
+     "enter_time": "20171011T145551.957000", "edge_id": 8414926848168493057},
+    {"leave_time": "20171020T090548.939000",
+     "enter_time": "20171020T090547.463000", "edge_id": 8414926848168493057},
+    {"leave_time": "20171024T144101.879000",
+     "enter_time": "20171024T144059.102000", "edge_id": 8414926848168493057},
+    {"leave_time": "20171022T131828.330000",
+     "enter_time": "20171022T131820.842000", "edge_id": 5342768494149337085},
+    {"leave_time": "20171014T134826.836000",
+     "enter_time": "20171014T134825.215000", "edge_id": 5342768494149337085},
+    {"leave_time": "20171010T060609.897000",
+     "enter_time": "20171010T060608.344000", "edge_id": 5342768494149337085},
+    {"leave_time": "20171027T082600.201000",
+     "enter_time": "20171027T082557.571000", "edge_id": 5342768494149337085}
+)
+
+# every travel time of test_yandex_maps is repeated to make input long enough for batching
+YANDEX_MAPS_TIMES_REPEAT = 5000
+
+
+@lru_cache(maxsize=1)
+def _yandex_travel_times():
+    # records are shared by all runs, graphs do not modify input records
+    return YANDEX_MAPS_TIMES * YANDEX_MAPS_TIMES_REPEAT
+
+
+def frozen_rows(table):
+    return tuple(frozenset(row.items()) for row in table)
+
+
+def multiset_eq(tb1, tb2):
+    return Counter(frozen_rows(tb1)) == Counter(frozen_rows(tb2))
+
+
+FIRST_TABLE = (
+    {'country_id': 1, 'name': 'John', 'surname': 'Black'},
+    {'country_id': 1, 'name': 'Antony', 'surname': 'Brown'},
+    {'country_id': 2, 'name': 'Alex', 'surname': 'Sidorov'},
+    {'country_id': 4, 'name': 'Frodo', 'surname': 'Ivanov'},
+    {'country_id': 4, 'name': 'Bilbo', 'surname': 'Beggins'},
+    {'country_id': 4, 'name': 'Frank', 'surname': 'Sinatra'},
+    {'country_id': 6, 'name': 'Xiao', 'surname': 'Hao'},
+)
+
+SECOND_TABLE = (
+    {'country_id': 2, 'capital': 'Moscow'},
+    {'country_id': 4, 'capital': 'Fairytail'},
+    {'country_id': 5, 'capital': 'New York'},
+)
+
+THIRD_TABLE = (
+    {'id': 1, 'mail': 'nsa@yandex.ru'},
+    {'id': 2, 'mail': 'sds@mail.ru'},
+)
+
+FORTH_TABLE = (
+    {'user_id': 1, 'message': 'this is text'},
+    {'user_id': 3, 'message': 'some text'},
+    {'user_id': 1, 'message': 'hello'},
+    {'user_id': 2, 'message': 'some text'},
+    {'user_id': 1, 'message': 'lolololo'},
+    {'user_id': 2, 'message': 'hi'},
+    {'user_id': 2, 'message': 'python__'},
+    {'user_id': 3, 'message': 'qeasd'},
+    {'user_id': 2, 'message': 'kek'},
+    {'user_id': 4, 'message': 'wew'},
+    {'user_id': 2, 'message': 'pewpew'}
+)
+
+ETALON_LEFT = frozen_rows([
+    {'country_id_left': 1, 'name': 'John', 'surname': 'Black', 'country_id_right': None, 'capital': None},
+    {'country_id_left': 1, 'name': 'Antony', 'surname': 'Brown', 'country_id_right': None, 'capital': None},
+    {'country_id_left': 2, 'name': 'Alex', 'surname': 'Sidorov', 'country_id_right': 2, 'capital': 'Moscow'},
+    {'country_id_left': 4, 'name': 'Frodo', 'surname': 'Ivanov', 'country_id_right': 4, 'capital': 'Fairytail'},
+    {'country_id_left': 4, 'name': 'Bilbo', 'surname': 'Beggins', 'country_id_right': 4, 'capital': 'Fairytail'},
+    {'country_id_left': 4, 'name': 'Frank', 'surname': 'Sinatra', 'country_id_right': 4, 'capital': 'Fairytail'},
+    {'country_id_left': 6, 'name': 'Xiao', 'surname': 'Hao', 'country_id_right': None, 'capital': None}
+])
+
+ETALON_INNER = frozen_rows([
+    {'country_id_left': 2, 'name': 'Alex', 'surname': 'Sidorov', 'country_id_right': 2, 'capital': 'Moscow'},
+    {'country_id_left': 4, 'name': 'Frodo', 'surname': 'Ivanov', 'country_id_right': 4, 'capital': 'Fairytail'},
+    {'country_id_left': 4, 'name': 'Bilbo', 'surname': 'Beggins', 'country_id_right': 4, 'capital': 'Fairytail'},
+    {'country_id_left': 4, 'name': 'Frank', 'surname': 'Sinatra', 'country_id_right': 4, 'capital': 'Fairytail'},
+])
+
+ETALON_RIGHT = frozen_rows([
+    {'country_id_left': 2, 'name': 'Alex', 'surname': 'Sidorov', 'country_id_right': 2, 'capital': 'Moscow'},
+    {'country_id_left': 4, 'name': 'Frodo', 'surname': 'Ivanov', 'country_id_right': 4, 'capital': 'Fairytail'},
+    {'country_id_left': 4, 'name': 'Bilbo', 'surname': 'Beggins', 'country_id_right': 4, 'capital': 'Fairytail'},
+    {'country_id_left': 4, 'name': 'Frank', 'surname': 'Sinatra', 'country_id_right': 4, 'capital': 'Fairytail'},
+    {'country_id_left': None, 'name': None, 'surname': None, 'country_id_right': 5, 'capital': 'New York'}
+])
+
+ETALON_FULL = frozen_rows([
+    {'country_id_left': 1, 'name': 'John', 'surname': 'Black', 'country_id_right': None, 'capital': None},
+    {'country_id_left': 1, 'name': 'Antony', 'surname': 'Brown', 'country_id_right': None, 'capital': None},
+    {'country_id_left': 2, 'name': 'Alex', 'surname': 'Sidorov', 'country_id_right': 2, 'capital': 'Moscow'},
+    {'country_id_left': 4, 'name': 'Frodo', 'surname': 'Ivanov', 'country_id_right': 4, 'capital': 'Fairytail'},
+    {'country_id_left': 4, 'name': 'Bilbo', 'surname': 'Beggins', 'country_id_right': 4, 'capital': 'Fairytail'},
+    {'country_id_left': 4, 'name': 'Frank', 'surname': 'Sinatra', 'country_id_right': 4, 'capital': 'Fairytail'},
+    {'country_id_left': None, 'name': None, 'surname': None, 'country_id_right': 5, 'capital': 'New York'},
+    {'country_id_left': 6, 'name': 'Xiao', 'surname': 'Hao', 'country_id_right': None, 'capital': None},
+])
+
+ETALON_WORD_COUNT = frozen_rows([
+    {'count': 1, 'text': 'hell'},
+    {'count': 1, 'text': 'world'},
+    {'count': 2, 'text': 'hello'},
+    {'count': 2, 'text': 'my'},
+    {'count': 3, 'text': 'little'}
+])
+
+ETALON_WORD_COUNT_SINGLE = frozen_rows([
+    {'count': 1, 'text': 'world'},
+    {'count': 1, 'text': 'hello'},
+    {'count': 1, 'text': 'my'},
+    {'count': 1, 'text': 'little'}
+])
+
+
+def build_join_graphs(first_source, second_source, key):
+    graphs = {}
+    for strategy in ('left', 'inner', 'right', 'full'):
+        first_graph = Graph(source=first_source)
+        second_graph = Graph(source=second_source)
+        first_graph.join(on=second_graph, key=key, strategy=strategy)
+        graphs[strategy] = first_graph
+    yield graphs
+    # graphs are shared by tests, so runs must not keep outputs and caches of graphs
+    for first_graph in graphs.values():
+        for graph in first_graph._topological_sort()[0]:
+            assert len(graph._cache) == 0
+            assert graph._output is None
+
+
+@pytest.fixture(scope='module')
+def country_join_graphs():
+    yield from build_join_graphs('first_table', 'second_table', 'country_id')
+
+
+@pytest.fixture(scope='module')
+def user_join_graphs():
+    yield from build_join_graphs('third_table', 'forth_table', ('id', 'user_id'))
+
+
+def approx_table(table, rel=0.001):
+    return [approx(row, rel=rel) for row in table]
+
+
+def test_word_count(word_count_graph):
     docs = [
         {'doc_id': 1, 'text': 'hello, my little WORLD'},
         {'doc_id': 2, 'text': 'Hello, my little little hell'}
     ]
 
-    etalon = [
-        {'count': 1, 'text': 'hell'},
-        {'count': 1, 'text': 'world'},
-        {'count': 2, 'text': 'hello'},
-        {'count': 2, 'text': 'my'},
-        {'count': 3, 'text': 'little'}
-    ]
-
-    g = algorithms.build_word_count_graph('docs')
+    result = word_count_graph.run(docs=docs)
 
-    result = g.run(docs=docs)
+    assert frozen_rows(result) == ETALON_WORD_COUNT
 
-    assert result == etalon
-
-
-def test_word_count_multiple_call():
-    g = algorithms.build_word_count_graph('text')
 
+def test_word_count_multiple_call(word_count_graph):
     rows1 = [
         {'doc_id': 1, 'text': 'hello, my little WORLD'},
     ]
 
-    etalon1 = [
-        {'count': 1, 'text': 'world'},
-        {'count': 1, 'text': 'hello'},
-        {'count': 1, 'text': 'my'},
-        {'count': 1, 'text': 'little'}
-    ]
-
-    result1 = g.run(
-        text=rows1
+    result1 = word_count_graph.run(
+        docs=rows1
     )
+    compile_count = word_count_graph._compile_count
 
     rows2 = [
         {'doc_id': 1, 'text': 'hello, my little WORLD'},
         {'doc_id': 2, 'text': 'Hello, my little little hell'}
     ]
 
-    etalon2 = [
-        {'count': 1, 'text': 'hell'},
-        {'count': 1, 'text': 'world'},
-        {'count': 2, 'text': 'hello'},
-        {'count': 2, 'text': 'my'},
-        {'count': 3, 'text': 'little'}
-    ]
-
-    result2 = g.run(
-        text=rows2,
-        verbose=True
+    result2 = word_count_graph.run(
+        docs=rows2
     )
-    print(etalon2)
-    print(result2)
-    assert sorted_eq(etalon1, result1, ['text'])
-    assert sorted_eq(etalon2, result2, ['text'])
 
+    # the execution plan is compiled once and reused by the next runs
+    assert word_count_graph._compile_count == compile_count
+    assert Counter(frozen_rows(result1)) == Counter(ETALON_WORD_COUNT_SINGLE)
+    assert Counter(frozen_rows(result2)) == Counter(ETALON_WORD_COUNT)
+
+
+def test_run_verbose(caplog, word_count_graph):
+    level = graph_module.logger.level
+    try:
+        result = word_count_graph.run(docs=[{'doc_id': 1, 'text': 'hello'}], verbose=True)
+    finally:
+        graph_module.logger.setLevel(level)
 
-def test_tf_idf():
+    assert result == [{'count': 1, 'text': 'hello'}]
+    assert "Computation of graph" in caplog.text
+
+
+def test_tf_idf(inverted_index_graph):
     rows = [
         {'doc_id': 1, 'text': 'hello, little world'},
         {'doc_id': 2, 'text': 'little'},
@@ -83,24 +246,68 @@ def test_tf_idf():
     ]
 
     etalon = [
-        {"text": "hello",  "doc_id": 5, "tf_idf": approx(0.2703, 0.001)},
-        {"text": "hello", "doc_id": 1, "tf_idf": approx(0.1351, 0.001)},
-        {"text": "hello", "doc_id": 4, "tf_idf": approx(0.1013, 0.001)},
-        {"text": "little", "doc_id": 2, "tf_idf": approx(0.4054, 0.001)},
-        {"text": "little", "doc_id": 3, "tf_idf": approx(0.4054, 0.001)},
-        {"text": "little", "doc_id": 4, "tf_idf": approx(0.2027, 0.001)},
-        {"text": "world", "doc_id": 6, "tf_idf": approx(0.3243, 0.001)},
-        {"text": "world", "doc_id": 1, "tf_idf": approx(0.1351, 0.001)},
-        {"text": "world", "doc_id": 5, "tf_idf": approx(0.1351, 0.001)}
+        {"text": "hello",  "doc_id": 5, "tf_idf": 0.2703},
+        {"text": "hello", "doc_id": 1, "tf_idf": 0.1351},
+        {"text": "hello", "doc_id": 4, "tf_idf": 0.1013},
+        {"text": "little", "doc_id": 2, "tf_idf": 0.4054},
+        {"text": "little", "doc_id": 3, "tf_idf": 0.4054},
+        {"text": "little", "doc_id": 4, "tf_idf": 0.2027},
+        {"text": "world", "doc_id": 6, "tf_idf": 0.3243},
+        {"text": "world", "doc_id": 1, "tf_idf": 0.1351},
+        {"text": "world", "doc_id": 5, "tf_idf": 0.1351}
     ]
 
-    g = algorithms.build_inverted_index_graph('texts')
-    result = g.run(texts=rows)
+    result = inverted_index_graph.run(texts=rows)
 
-    assert result == etalon
+    assert result == approx_table(etalon)
+
+
+def test_tf_idf_concurrent(inverted_index_graph):
+    rows = [
+        {'doc_id': 1, 'text': 'hello, little world'},
+        {'doc_id': 2, 'text': 'little'},
+        {'doc_id': 3, 'text': 'little little little'},
+        {'doc_id': 4, 'text': 'little? hello little world'},
+        {'doc_id': 5, 'text': 'HELLO HELLO! WORLD...'},
+        {'doc_id': 6, 'text': 'world? world... world!!! WORLD!!! HELLO!!!'}
+    ]
+
+    serial_result = inverted_index_graph.run(texts=rows)
+    concurrent_result = algorithms.build_inverted_index_graph('texts').run(texts=rows, max_workers=4)
+    assert concurrent_result == serial_result
+
+
+def test_run_concurrently():
+    threads = {'first': set(), 'second': set()}
 
+    def make_mapper(name):
+        def mapper(record):
+            threads[name].add(threading.current_thread())
+            if record['value'] < 0:
+                raise ValueError("Negative value")
+            yield record
+        return mapper
 
-def test_pmi():
+    first_graph = Graph(source='first_table')
+    first_graph.map(make_mapper('first'))
+    second_graph = Graph(source='second_table')
+    second_graph.map(make_mapper('second'))
+    second_graph.cache()
+    first_graph.join(on=second_graph, key='value', strategy='inner')
+
+    result = first_graph.run(first_table=[{'value': 1}], second_table=[{'value': 1}], max_workers=2)
+    assert result == [{'value_left': 1, 'value_right': 1}]
+    # cached graph is computed by the pool, output of not cached graph is streamed to its consumer
+    assert threading.main_thread() not in threads['second']
+    assert threads['first'] == {threading.main_thread()}
+
+    with pytest.raises(ValueError):
+        first_graph.run(first_table=[{'value': 1}], second_table=[{'value': -1}], max_workers=2)
+    with pytest.raises(ValueError):
+        first_graph.run(first_table=[{'value': -1}], second_table=[{'value': 1}], max_workers=2)
+
+
+def test_pmi(pmi_graph):
     rows = [
         {'doc_id': 1, 'text': 'hello, little world'},
         {'doc_id': 2, 'text': 'little'},
@@ -111,112 +318,68 @@ def test_pmi():
     ]
 
     etalon = [
-        {'text': 'little', 'doc_id': 3, 'pmi': approx(1.0498, 0.001)},
-        {'text': 'little', 'doc_id': 4, 'pmi': approx(0.3567, 0.001)},
-        {'text': 'hello', 'doc_id': 5, 'pmi': approx(0.7985, 0.001)},
-        {'text': 'world', 'doc_id': 6, 'pmi': approx(0.6444, 0.001)},
-        {'text': 'hello', 'doc_id': 6, 'pmi': approx(0.1054, 0.001)}
+        {'text': 'little', 'doc_id': 3, 'pmi': 1.0498},
+        {'text': 'little', 'doc_id': 4, 'pmi': 0.3567},
+        {'text': 'hello', 'doc_id': 5, 'pmi': 0.7985},
+        {'text': 'world', 'doc_id': 6, 'pmi': 0.6444},
+        {'text': 'hello', 'doc_id': 6, 'pmi': 0.1054}
     ]
 
-    g = algorithms.build_pmi_graph('texts')   # must work with iterable
-    result = g.run(texts=iter(rows))
-
-    assert etalon == result
-
-
-def test_yandex_maps():
-    lengths = [
-        {"start": [37.84870228730142, 55.73853974696249], "end": [37.8490418381989, 55.73832445777953],
-         "edge_id": 8414926848168493057},
-        {"start": [37.524768467992544, 55.88785375468433], "end": [37.52415172755718, 55.88807155843824],
-         "edge_id": 5342768494149337085},
-        {"start": [37.56963176652789, 55.846845586784184], "end": [37.57018438540399, 55.8469259692356],
-         "edge_id": 5123042926973124604},
-        {"start": [37.41463478654623, 55.654487907886505], "end": [37.41442892700434, 55.654839486815035],
-         "edge_id": 5726148664276615162},
-        {"start": [37.584684155881405, 55.78285809606314], "end": [37.58415022864938, 55.78177368734032],
-         "edge_id": 451916977441439743},
-        {"start": [37.736429711803794, 55.62696328852326], "end": [37.736344216391444, 55.626937723718584],
-         "edge_id": 7639557040160407543},
-        {"start": [37.83196756616235, 55.76662947423756], "end": [37.83191015012562, 55.766647034324706],
-         "edge_id": 1293255682152955894},
-    ]
+    result = pmi_graph.run(texts=iter(rows))   # must work with iterable
+
+    assert result == approx_table(etalon)
+
 
-    times = [
-        {"leave_time": "20171020T112238.723000",
-         "enter_time": "20171020T112237.427000", "edge_id": 8414926848168493057},
-        {"leave_time": "20171011T145553.040000",
-         "enter_time": "20171011T145551.957000", "edge_id": 8414926848168493057},
-        {"leave_time": "20171020T090548.939000",
-         "enter_time": "20171020T090547.463000", "edge_id": 8414926848168493057},
-        {"leave_time": "20171024T144101.879000",
-         "enter_time": "20171024T144059.102000", "edge_id": 8414926848168493057},
-        {"leave_time": "20171022T131828.330000",
-         "enter_time": "20171022T131820.842000", "edge_id": 5342768494149337085},
-        {"leave_time": "20171014T134826.836000",
-         "enter_time": "20171014T134825.215000", "edge_id": 5342768494149337085},
-        {"leave_time": "20171010T060609.897000",
-         "enter_time": "20171010T060608.344000", "edge_id": 5342768494149337085},
-        {"leave_time": "20171027T082600.201000",
-         "enter_time": "20171027T082557.571000", "edge_id": 5342768494149337085}
+def test_pmi_short_and_rare_words(pmi_graph):
+    rows = [
+        {'doc_id': 1, 'text': 'hello hello cat cat cat world'},
+        {'doc_id': 2, 'text': 'world world dog dog unique'},
+        {'doc_id': 3, 'text': 'hello, little: little cat'}
     ]
 
+    # short words are not in the result, but frequencies are relative to all words
     etalon = [
-        {'weekday': 'Fri', 'hour': 8, 'speed': approx(97.4886, 0.001)},
-        {'weekday': 'Fri', 'hour': 9, 'speed': approx(102.9903, 0.001)},
-        {'weekday': 'Fri', 'hour': 11, 'speed': approx(117.2945, 0.001)},
-        {'weekday': 'Sat', 'hour': 13, 'speed': approx(158.1709, 0.001)},
-        {'weekday': 'Sun', 'hour': 13, 'speed': approx(34.2408, 0.001)},
-        {'weekday': 'Tue', 'hour': 6, 'speed': approx(165.0966, 0.001)},
-        {'weekday': 'Tue', 'hour': 14, 'speed': approx(54.7402, 0.001)},
-        {'weekday': 'Wed', 'hour': 14, 'speed': approx(140.3635, 0.001)}
+        {'text': 'hello', 'doc_id': 1, 'pmi': 0.5108},
+        {'text': 'world', 'doc_id': 2, 'pmi': 0.6931},
+        {'text': 'little', 'doc_id': 3, 'pmi': 1.3218}
     ]
 
-    g = algorithms.build_yandex_maps_graph('travel_times', 'lengths')
+    assert pmi_graph.run(texts=rows) == approx_table(etalon)
+
 
-    result = g.run(
-        travel_times=islice(cycle(iter(times)), len(times) * 5000),
-        lengths=iter(lengths)
+def test_yandex_maps(yandex_maps_graph):
+    etalon = [
+        {'weekday': 'Fri', 'hour': 8, 'speed': 62.2157},
+        {'weekday': 'Fri', 'hour': 9, 'speed': 78.0862},
+        {'weekday': 'Fri', 'hour': 11, 'speed': 88.9315},
+        {'weekday': 'Sat', 'hour': 13, 'speed': 100.9422},
+        {'weekday': 'Sun', 'hour': 13, 'speed': 21.8519},
+        {'weekday': 'Tue', 'hour': 6, 'speed': 105.3620},
+        {'weekday': 'Tue', 'hour': 14, 'speed': 41.5035},
+        {'weekday': 'Wed', 'hour': 14, 'speed': 106.4222}
+    ]
+
+    result = yandex_maps_graph.run(
+        travel_times=iter(_yandex_travel_times()),
+        lengths=iter(YANDEX_MAPS_LENGTHS)
     )
 
-    assert sorted(result, key=lambda x: (x['weekday'], x['hour'])) == \
-        sorted(etalon, key=lambda x: (x['weekday'], x['hour']))
+    key_function = itemgetter('weekday', 'hour')
+    assert sorted(result, key=key_function) == approx_table(sorted(etalon, key=key_function))
 
 
-def test_left_join():
-    first_graph = Graph(source='first_table')
-    second_graph = Graph(source='second_table')
-    first_graph.join(on=second_graph, key='country_id', strategy='left')
+@pytest.mark.parametrize('strategy,etalon', [
+    ('left', ETALON_LEFT),
+    ('inner', ETALON_INNER),
+    ('right', ETALON_RIGHT),
+    ('full', ETALON_FULL)
+])
+def test_country_join(strategy, etalon, country_join_graphs):
+    result = country_join_graphs[strategy].run(first_table=FIRST_TABLE, second_table=SECOND_TABLE)
+    assert frozen_rows(result) == etalon
 
-    first_table = [
-        {'country_id': 1, 'name': 'John', 'surname': 'Black'},
-        {'country_id': 1, 'name': 'Antony', 'surname': 'Brown'},
-        {'country_id': 2, 'name': 'Alex', 'surname': 'Sidorov'},
-        {'country_id': 4, 'name': 'Frodo', 'surname': 'Ivanov'},
-        {'country_id': 4, 'name': 'Bilbo', 'surname': 'Beggins'},
-        {'country_id': 4, 'name': 'Frank', 'surname': 'Sinatra'},
-        {'country_id': 6, 'name': 'Xiao', 'surname': 'Hao'},
-    ]
-
-    second_table = [
-        {'country_id': 2, 'capital': 'Moscow'},
-        {'country_id': 4, 'capital': 'Fairytail'},
-        {'country_id': 5, 'capital': 'New York'},
-    ]
-
-    etalon_first = [
-        {'country_id_left': 1, 'name': 'John', 'surname': 'Black', 'country_id_right': None, 'capital': None},
-        {'country_id_left': 1, 'name': 'Antony', 'surname': 'Brown', 'country_id_right': None, 'capital': None},
-        {'country_id_left': 2, 'name': 'Alex', 'surname': 'Sidorov', 'country_id_right': 2, 'capital': 'Moscow'},
-        {'country_id_left': 4, 'name': 'Frodo', 'surname': 'Ivanov', 'country_id_right': 4, 'capital': 'Fairytail'},
-        {'country_id_left': 4, 'name': 'Bilbo', 'surname': 'Beggins', 'country_id_right': 4, 'capital': 'Fairytail'},
-        {'country_id_left': 4, 'name': 'Frank', 'surname': 'Sinatra', 'country_id_right': 4, 'capital': 'Fairytail'},
-        {'country_id_left': 6, 'name': 'Xiao', 'surname': 'Hao', 'country_id_right': None, 'capital': None}
-    ]
-
-    result_first = first_graph.run(first_table=first_table, second_table=second_table)
-    assert etalon_first == result_first
 
+def test_left_join(user_join_graphs):
     third_graph = Graph(source='first_table')
     fourth_graph = Graph(source='second_table')
     fourth_graph.join(on=third_graph, key='country_id', strategy='left')
@@ -229,31 +392,10 @@ def test_left_join():
         {'country_id_left': 5, 'capital': 'New York', 'country_id_right': None, 'name': None, 'surname': None}
     ]
 
-    result_second = fourth_graph.run(first_table=first_table, second_table=second_table)
+    result_second = fourth_graph.run(first_table=FIRST_TABLE, second_table=SECOND_TABLE)
     assert etalon_second == result_second
 
-    fifth_graph = Graph(source='third_table')
-    sixth_graph = Graph(source='forth_table')
-    fifth_graph.join(on=sixth_graph, key=('id', 'user_id'), strategy='left')
-
-    third_table = [
-        {'id': 1, 'mail': 'nsa@yandex.ru'},
-        {'id': 2, 'mail': 'sds@mail.ru'},
-    ]
-
-    forth_table = [
-        {'user_id': 1, 'message': 'this is text'},
-        {'user_id': 3, 'message': 'some text'},
-        {'user_id': 1, 'message': 'hello'},
-        {'user_id': 2, 'message': 'some text'},
-        {'user_id': 1, 'message': 'lolololo'},
-        {'user_id': 2, 'message': 'hi'},
-        {'user_id': 2, 'message': 'python__'},
-        {'user_id': 3, 'message': 'qeasd'},
-        {'user_id': 2, 'message': 'kek'},
-        {'user_id': 4, 'message': 'wew'},
-        {'user_id': 2, 'message': 'pewpew'}
-    ]
+    fifth_graph = user_join_graphs['left']
 
     etalon_third = [
         {'user_id': 1, 'message': 'this is text', 'id': 1, 'mail': 'nsa@yandex.ru'},
@@ -265,65 +407,13 @@ def test_left_join():
         {'user_id': 2, 'message': 'kek', 'id': 2, 'mail': 'sds@mail.ru'},
         {'user_id': 2, 'message': 'pewpew', 'id': 2, 'mail': 'sds@mail.ru'}
     ]
-    result_third = fifth_graph.run(third_table=third_table, forth_table=forth_table)
+    result_third = fifth_graph.run(third_table=THIRD_TABLE, forth_table=FORTH_TABLE)
 
-    assert sorted(etalon_third, key=lambda x: (x['user_id'], x['message'])) == \
-        sorted(result_third, key=lambda x: (x['user_id'], x['message']))
+    assert multiset_eq(etalon_third, result_third)
 
 
-def test_inner_join():
-    first_graph = Graph(source='first_table')
-    second_graph = Graph(source='second_table')
-    first_graph.join(on=second_graph, key='country_id', strategy='inner')
-
-    first_table = [
-        {'country_id': 1, 'name': 'John', 'surname': 'Black'},
-        {'country_id': 1, 'name': 'Antony', 'surname': 'Brown'},
-        {'country_id': 2, 'name': 'Alex', 'surname': 'Sidorov'},
-        {'country_id': 4, 'name': 'Frodo', 'surname': 'Ivanov'},
-        {'country_id': 4, 'name': 'Bilbo', 'surname': 'Beggins'},
-        {'country_id': 4, 'name': 'Frank', 'surname': 'Sinatra'},
-        {'country_id': 6, 'name': 'Xiao', 'surname': 'Hao'},
-    ]
-
-    second_table = [
-        {'country_id': 2, 'capital': 'Moscow'},
-        {'country_id': 4, 'capital': 'Fairytail'},
-        {'country_id': 5, 'capital': 'New York'},
-    ]
-
-    etalon_first = [
-        {'country_id_left': 2, 'name': 'Alex', 'surname': 'Sidorov', 'country_id_right': 2, 'capital': 'Moscow'},
-        {'country_id_left': 4, 'name': 'Frodo', 'surname': 'Ivanov', 'country_id_right': 4, 'capital': 'Fairytail'},
-        {'country_id_left': 4, 'name': 'Bilbo', 'surname': 'Beggins', 'country_id_right': 4, 'capital': 'Fairytail'},
-        {'country_id_left': 4, 'name': 'Frank', 'surname': 'Sinatra', 'country_id_right': 4, 'capital': 'Fairytail'},
-    ]
-
-    result_first = first_graph.run(first_table=first_table, second_table=second_table)
-    assert etalon_first == result_first
-
-    fifth_graph = Graph(source='third_table')
-    sixth_graph = Graph(source='forth_table')
-    fifth_graph.join(on=sixth_graph, key=('id', 'user_id'), strategy='inner')
-
-    third_table = [
-        {'id': 1, 'mail': 'nsa@yandex.ru'},
-        {'id': 2, 'mail': 'sds@mail.ru'},
-    ]
-
-    forth_table = [
-        {'user_id': 1, 'message': 'this is text'},
-        {'user_id': 3, 'message': 'some text'},
-        {'user_id': 1, 'message': 'hello'},
-        {'user_id': 2, 'message': 'some text'},
-        {'user_id': 1, 'message': 'lolololo'},
-        {'user_id': 2, 'message': 'hi'},
-        {'user_id': 2, 'message': 'python__'},
-        {'user_id': 3, 'message': 'qeasd'},
-        {'user_id': 2, 'message': 'kek'},
-        {'user_id': 4, 'message': 'wew'},
-        {'user_id': 2, 'message': 'pewpew'}
-    ]
+def test_inner_join(user_join_graphs):
+    fifth_graph = user_join_graphs['inner']
 
     etalon_third = [
         {'user_id': 1, 'message': 'this is text', 'id': 1, 'mail': 'nsa@yandex.ru'},
@@ -335,79 +425,48 @@ def test_inner_join():
         {'user_id': 2, 'message': 'kek', 'id': 2, 'mail': 'sds@mail.ru'},
         {'user_id': 2, 'message': 'pewpew', 'id': 2, 'mail': 'sds@mail.ru'}
     ]
-    result_third = fifth_graph.run(third_table=third_table, forth_table=forth_table)
+    result_third = fifth_graph.run(third_table=THIRD_TABLE, forth_table=FORTH_TABLE)
 
-    assert sorted(etalon_third, key=lambda x: (x['user_id'], x['message'])) == \
-        sorted(result_third, key=lambda x: (x['user_id'], x['message']))
+    assert multiset_eq(etalon_third, result_third)
 
 
-def test_right_join():
-    first_graph = Graph(source='first_table')
-    second_graph = Graph(source='second_table')
-    first_graph.join(on=second_graph, key='country_id', strategy='right')
+def test_hash_join_equals_sort_merge_join(monkeypatch):
+    first_table = [{'id': value % 7, 'first': value} for value in range(30)]
+    second_table = [{'id': value % 5, 'second': value} for value in range(0, 30, 3)]
 
-    first_table = [
-        {'country_id': 1, 'name': 'John', 'surname': 'Black'},
-        {'country_id': 1, 'name': 'Antony', 'surname': 'Brown'},
-        {'country_id': 2, 'name': 'Alex', 'surname': 'Sidorov'},
-        {'country_id': 4, 'name': 'Frodo', 'surname': 'Ivanov'},
-        {'country_id': 4, 'name': 'Bilbo', 'surname': 'Beggins'},
-        {'country_id': 4, 'name': 'Frank', 'surname': 'Sinatra'},
-        {'country_id': 6, 'name': 'Xiao', 'surname': 'Hao'},
-    ]
+    def run_join(strategy):
+        first_graph = Graph(source='first_table')
+        second_graph = Graph(source='second_table')
+        first_graph.join(on=second_graph, key='id', strategy=strategy)
+        result = first_graph.run(first_table=first_table, second_table=second_table)
+        return Counter(frozen_rows(result))
 
-    second_table = [
-        {'country_id': 2, 'capital': 'Moscow'},
-        {'country_id': 4, 'capital': 'Fairytail'},
-        {'country_id': 5, 'capital': 'New York'},
-    ]
+    for strategy in ('inner', 'left', 'right'):
+        hash_join_result = run_join(strategy)
+        monkeypatch.setattr(graph_module, 'HASH_JOIN_MEMORY_LIMIT', 0)
+        sort_merge_join_result = run_join(strategy)
+        monkeypatch.undo()
+        assert hash_join_result == sort_merge_join_result
 
-    etalon_first = [
-        {'country_id_left': 2, 'name': 'Alex', 'surname': 'Sidorov', 'country_id_right': 2, 'capital': 'Moscow'},
-        {'country_id_left': 4, 'name': 'Frodo', 'surname': 'Ivanov', 'country_id_right': 4, 'capital': 'Fairytail'},
-        {'country_id_left': 4, 'name': 'Bilbo', 'surname': 'Beggins', 'country_id_right': 4, 'capital': 'Fairytail'},
-        {'country_id_left': 4, 'name': 'Frank', 'surname': 'Sinatra', 'country_id_right': 4, 'capital': 'Fairytail'},
-        {'country_id_left': None, 'name': None, 'surname': None, 'country_id_right': 5, 'capital': 'New York'}
-    ]
 
-    result_first = first_graph.run(first_table=first_table, second_table=second_table)
-    assert etalon_first == result_first
-
-
-def test_full_join():
-    first_graph = Graph(source='first_table')
-    second_graph = Graph(source='second_table')
-    first_graph.join(on=second_graph, key='country_id', strategy='full')
-
-    first_table = [
-        {'country_id': 1, 'name': 'John', 'surname': 'Black'},
-        {'country_id': 1, 'name': 'Antony', 'surname': 'Brown'},
-        {'country_id': 2, 'name': 'Alex', 'surname': 'Sidorov'},
-        {'country_id': 4, 'name': 'Frodo', 'surname': 'Ivanov'},
-        {'country_id': 4, 'name': 'Bilbo', 'surname': 'Beggins'},
-        {'country_id': 4, 'name': 'Frank', 'surname': 'Sinatra'},
-        {'country_id': 6, 'name': 'Xiao', 'surname': 'Hao'},
-    ]
+def test_hash_join_unhashable_probe_key():
+    first_table = [{'id': 1, 'first': 1}, {'id': [2], 'first': 2}, {'id': 3, 'first': 3}]
+    second_table = [{'id': 1, 'second': 1}]
+    etalon = {
+        'left': [{'id_left': 1, 'first': 1, 'id_right': 1, 'second': 1},
+                 {'id_left': [2], 'first': 2, 'id_right': None, 'second': None},
+                 {'id_left': 3, 'first': 3, 'id_right': None, 'second': None}],
+        'inner': [{'id_left': 1, 'first': 1, 'id_right': 1, 'second': 1}]
+    }
 
-    second_table = [
-        {'country_id': 2, 'capital': 'Moscow'},
-        {'country_id': 4, 'capital': 'Fairytail'},
-        {'country_id': 5, 'capital': 'New York'},
-    ]
+    for strategy in ('left', 'inner'):
+        first_graph = Graph(source='first_table')
+        second_graph = Graph(source='second_table')
+        first_graph.join(on=second_graph, key='id', strategy=strategy)
 
-    etalon_first = [
-        {'country_id_left': 1, 'name': 'John', 'surname': 'Black', 'country_id_right': None, 'capital': None},
-        {'country_id_left': 1, 'name': 'Antony', 'surname': 'Brown', 'country_id_right': None, 'capital': None},
-        {'country_id_left': 2, 'name': 'Alex', 'surname': 'Sidorov', 'country_id_right': 2, 'capital': 'Moscow'},
-        {'country_id_left': 4, 'name': 'Frodo', 'surname': 'Ivanov', 'country_id_right': 4, 'capital': 'Fairytail'},
-        {'country_id_left': 4, 'name': 'Bilbo', 'surname': 'Beggins', 'country_id_right': 4, 'capital': 'Fairytail'},
-        {'country_id_left': 4, 'name': 'Frank', 'surname': 'Sinatra', 'country_id_right': 4, 'capital': 'Fairytail'},
-        {'country_id_left': None, 'name': None, 'surname': None, 'country_id_right': 5, 'capital': 'New York'},
-        {'country_id_left': 6, 'name': 'Xiao', 'surname': 'Hao', 'country_id_right': None, 'capital': None},
-    ]
+        result = first_graph.run(first_table=first_table, second_table=second_table)
 
-    result_first = first_graph.run(first_table=first_table, second_table=second_table)
-    assert etalon_first == result_first
+        assert result == etalon[strategy]
 
 
 def test_cross_join():
@@ -440,8 +499,12 @@ def test_cross_join():
     ]
 
     result_first = first_graph.run(first_table=first_table, second_table=second_table)
-    assert sorted(etalon_first, key=lambda x: (x['country_id'], x['name'], x['capital'])) == \
-        sorted(result_first, key=lambda x: (x['country_id'], x['name'], x['capital']))
+    assert multiset_eq(etalon_first, result_first)
+
+
+def test_tokenize():
+    assert textutils.tokenize('Hello, my little WORLD... 42_times!\n[don\'t]') == \
+        ['hello', 'my', 'little', 'world', '42_times', "don't"]
 
 
 def test_map():
@@ -470,6 +533,108 @@ def test_map():
     assert result == etalon
 
 
+def test_node_run():
+
+    def mapper(record):
+        yield {'value': record['value'] * 2}
+
+    def folder(state, record):
+        state['value'] += record['value']
+        return state
+
+    table = [{'value': value} for value in range(10)]
+
+    assert list(graph_module.Map(mapper).run(iter(table))) == [{'value': value * 2} for value in range(10)]
+    assert list(graph_module.Fold(folder, {'value': 0}).run(iter(table))) == [{'value': 45}]
+    with pytest.raises(TypeError):
+        graph_module.Node()
+
+
+def test_map_chain():
+
+    def split_mapper(record):
+        for word in record['text'].split():
+            yield {'word': word}
+
+    def upper_mapper(record):
+        yield {'word': record['word'].upper()}
+
+    table = [
+        {'text': 'some text'},
+        {'text': 'hello'}
+    ]
+
+    etalon = [
+        {'word': 'SOME'},
+        {'word': 'TEXT'},
+        {'word': 'HELLO'}
+    ]
+
+    my_graph = Graph(source='table')
+    my_graph.map(split_mapper)
+    my_graph.map(upper_mapper)
+    assert my_graph.run(table=table) == etalon
+    assert my_graph.run(table=table) == etalon
+    assert my_graph._compile_count == 1
+
+
+def test_batched_map():
+
+    @batched_mapper
+    def mapper(records):
+        for record in records:
+            yield {'value': record['value'] * 2}
+
+    table = [{'value': value} for value in range(10000)]
+    etalon = [{'value': value * 2} for value in range(10000)]
+
+    my_graph = Graph(source='table')
+    my_graph.map(mapper)
+    result = my_graph.run(table=table)
+    assert result == etalon
+
+
+def test_micro_batches(monkeypatch):
+    monkeypatch.setattr(graph_module, 'BATCH_SIZE', 3)
+
+    def mapper(record):
+        if record['value'] % 2 == 0:
+            yield {'value': record['value']}
+
+    def folder(state, record):
+        return {'sum': state['sum'] + record['value'], 'count': state['count'] + 1}
+
+    my_graph = Graph(source='table')
+    my_graph.map(mapper)
+    my_graph.fold(folder, {'sum': 0, 'count': 0})
+    result = my_graph.run(table=[{'value': value} for value in range(10)])
+    assert result == [{'sum': 20, 'count': 5}]
+
+
+def test_specialize():
+    table = [
+        {'doc_id': '1', 'text': 'hello', 'extra': 0.5},
+        {'doc_id': '2', 'text': 'world', 'extra': 1.5}
+    ]
+    etalon = [
+        {'doc_id': 1, 'text': 'HELLO'},
+        {'doc_id': 2, 'text': 'WORLD'}
+    ]
+
+    def mapper(record):
+        record['text'] = record['text'].upper()
+        yield record
+
+    my_graph = Graph(source='table')
+    my_graph.map(mapper)
+    my_graph.specialize({'doc_id': int, 'text': object})
+
+    assert my_graph.run(table=table) == etalon
+    stream = io.StringIO(''.join(json.dumps(record) + '\n' for record in table))
+    assert my_graph.run(table=stream) == etalon
+    assert graph_module.specialized_reader({'doc_id': int, 'text': object}) is my_graph._read_specialized
+
+
 def test_sort():
 
     table = [
@@ -511,6 +676,26 @@ def test_sort():
     result = my_graph.run(table=table)
     assert result == second_etalon
 
+    my_graph.sort('value')
+    my_graph.sort('value', 'text', 'text')
+    assert len(my_graph._nodes) == 1
+    assert my_graph.run(table=table) == second_etalon
+    my_graph.sort('value', reverse=True)
+    assert len(my_graph._nodes) == 2
+
+
+def test_external_sort(monkeypatch):
+    monkeypatch.setattr(graph_module, 'SORT_BUFFER_SIZE', 7)
+    monkeypatch.setattr(graph_module, 'SPILL_CHUNK_SIZE', 3)
+
+    table = [{'value': (value * 37) % 10, 'order': value} for value in range(50)]
+
+    for reverse in (False, True):
+        my_graph = Graph(source='table')
+        my_graph.sort('value', reverse=reverse)
+        result = my_graph.run(table=table)
+        assert result == sorted(table, key=itemgetter('value'), reverse=reverse)
+
 
 def test_fold():
 
@@ -528,32 +713,44 @@ def test_fold():
         {'first_value': 151, 'second_value': 192.19002}
     ]
 
-    etalon = [
-        {'first_value': 374, 'second_value': approx(2203.50973, 0.001)}
-    ]
-
     my_graph = Graph(source='table')
     my_graph.fold(folder, {'first_value': 0, 'second_value': 0.0})
 
     result = my_graph.run(table=table)
-    assert result == etalon
+    assert len(result) == 1
+    assert result[0]['first_value'] == 374 and isclose(result[0]['second_value'], 2203.50973, rel_tol=1e-3)
+
+
+def test_fold_primitive(monkeypatch):
+    monkeypatch.setattr(graph_module, 'BATCH_SIZE', 4)
+    table = [{'value': value % 7} for value in range(20)]
+
+    for kind, etalon in [('sum', 57), ('count', 20), ('min', 0), ('max', 6)]:
+
+        @fold_primitive(kind, column='value')
+        def folder(state, record):
+            raise AssertionError("Folder marked as fold primitive is not called")
+
+        my_graph = Graph(source='table')
+        my_graph.fold(folder, {'value': 0 if kind in ('sum', 'count') else None})
+        assert my_graph.run(table=table) == [{'value': etalon}]
+        assert my_graph.run(table=table) == [{'value': etalon}]
 
 
 def test_reduce():
 
     def reducer(records):
-        word_count = Counter()
+        word_count = {}
+        total = 0
 
         for record in records:
-            word_count[record['word']] += 1
+            word = record['word']
+            word_count[word] = word_count.get(word, 0) + 1
+            total += 1
 
-        total = sum(word_count.values())
-        for word, count in word_count.items():
-            yield {
-                'word': word,
-                'freq': count / total,
-                'group': record['group']
-            }
+        # all records of one call have the same group
+        group = record['group']
+        yield from ({'word': word, 'freq': count / total, 'group': group} for word, count in word_count.items())
 
     table = [
         {'word': 'animation', 'group': 'child'},
@@ -565,10 +762,10 @@ def test_reduce():
     ]
 
     etalon = [
-        {'word': 'animation', 'freq': approx(0.75, 0.001), 'group': 'child'},
-        {'word': 'hi', 'freq': approx(0.25, 0.001), 'group': 'child'},
-        {'word': 'binary', 'freq': approx(0.5, 0.001), 'group': 'programming'},
-        {'word': 'pyython', 'freq': approx(0.5, 0.001), 'group': 'programming'}
+        {'word': 'animation', 'freq': 0.75, 'group': 'child'},
+        {'word': 'hi', 'freq': 0.25, 'group': 'child'},
+        {'word': 'binary', 'freq': 0.5, 'group': 'programming'},
+        {'word': 'pyython', 'freq': 0.5, 'group': 'programming'}
     ]
 
     my_graph = Graph(source='table')
@@ -576,4 +773,230 @@ def test_reduce():
     my_graph.reduce(reducer, key='group')
 
     result = my_graph.run(table=table)
-    assert result == etalon
+    assert result == approx_table(etalon)
+
+
+def test_columnar_cache():
+    table = [{'value': value, 'text': str(value)} for value in range(5)]
+
+    cache = graph_module.ColumnarCache()
+    cache.extend(table)
+    assert len(cache) == 5
+    assert list(cache) == table
+    assert list(cache) == table
+
+    cache.extend([{'other': 1}])
+    assert len(cache) == 6
+    assert list(cache) == table + [{'other': 1}]
+
+
+def test_cache_eviction():
+
+    def mapper(record):
+        yield {'id': record['id'], 'double': record['value'] * 2}
+
+    table = [{'id': value, 'value': value} for value in range(5)]
+
+    source_graph = Graph(source='table')
+    left_graph = Graph(source=source_graph)
+    right_graph = Graph(source=source_graph)
+    right_graph.map(mapper)
+    left_graph.join(on=right_graph, key='id', strategy='inner')
+
+    result = left_graph.run(table=table)
+    assert len(source_graph._cache) == 0
+    assert result == [{'id_left': value, 'value': value, 'id_right': value, 'double': value * 2}
+                      for value in range(5)]
+
+
+def test_graph_cache(monkeypatch):
+    monkeypatch.setattr(graph_module, 'SPILL_CHUNK_SIZE', 3)
+    table = [{'id': value, 'value': value % 4} for value in range(10)]
+
+    def mapper(record):
+        yield {'id': record['id'], 'double': record['value'] * 2}
+
+    for spill in (False, True):
+        source_graph = Graph(source='table')
+        source_graph.map(mapper)
+        source_graph.cache(spill=spill)
+        sorted_graph = Graph(source=source_graph)
+        sorted_graph.sort('double')
+
+        assert source_graph.run(table=table) == [{'id': value, 'double': value % 4 * 2} for value in range(10)]
+        assert sorted_graph.run(table=table) == sorted(source_graph.run(table=table), key=itemgetter('double'))
+
+
+def test_topological_sort():
+
+    def mapper(record):
+        yield {'id': record['id'], 'double': record['value'] * 2}
+
+    table = [{'id': value, 'value': value} for value in range(5)]
+    etalon = [{'id_left': value, 'value': value, 'id_right': value, 'double': value * 2}
+              for value in range(5)]
+
+    source_graph = Graph(source='table')
+    left_graph = Graph(source=source_graph)
+    right_graph = Graph(source=source_graph)
+    right_graph.map(mapper)
+    left_graph.join(on=right_graph, key='id', strategy='inner')
+
+    order, _ = left_graph._topological_sort()
+    assert order == [source_graph, right_graph, left_graph]
+    assert left_graph._topological_sort()[0] is order
+
+    assert left_graph.run(table=table) == etalon
+    assert left_graph.run(table=table) == etalon
+
+
+def test_run_cache(tmp_path):
+    input_path = tmp_path / 'docs.txt'
+    with open(input_path, 'w') as input_file:
+        input_file.write(json.dumps({'doc_id': 1, 'text': 'hello, my little WORLD'}) + '\n')
+
+    g = algorithms.build_word_count_graph('docs')
+    cache_dir = str(tmp_path / 'cache')
+
+    with open(input_path) as input_file:
+        result = g.run(docs=input_file, cache_dir=cache_dir)
+    assert len(result) == 4
+
+    cache_files = os.listdir(cache_dir)
+    assert len(cache_files) == 1
+    with open(os.path.join(cache_dir, cache_files[0]), 'wb') as cache_file:
+        pickle.dump([{'count': 42, 'text': 'cached'}], cache_file)
+
+    with open(input_path) as input_file:
+        assert g.run(docs=input_file, cache_dir=cache_dir) == [{'count': 42, 'text': 'cached'}]
+
+    other_graph = algorithms.build_word_count_graph('docs', count_column='number')
+    with open(input_path) as input_file:
+        assert len(other_graph.run(docs=input_file, cache_dir=cache_dir)) == 4
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_run_cache_global_values(tmp_path):
+    input_path = tmp_path / 'table.txt'
+    with open(input_path, 'w') as input_file:
+        input_file.write('{"v": 1}\n{"v": 2}\n')
+
+    namespace = {'FACTOR': 10}
+    exec("def mapper(record):\n    yield {'v': record['v'] * FACTOR}", namespace)
+    g = Graph(source='table')
+    g.map(namespace['mapper'])
+    cache_dir = str(tmp_path / 'cache')
+
+    with open(input_path) as input_file:
+        assert g.run(table=input_file, cache_dir=cache_dir) == [{'v': 10}, {'v': 20}]
+
+    namespace['FACTOR'] = 1000
+    with open(input_path) as input_file:
+        assert g.run(table=input_file, cache_dir=cache_dir) == [{'v': 1000}, {'v': 2000}]
+    assert len(os.listdir(cache_dir)) == 2
+
+
+NODE_FINGERPRINTS_SCRIPT = """
+from tests import algorithms
+from graph.src import graph as graph_module
+graphs = [algorithms.build_word_count_graph('docs'), algorithms.build_inverted_index_graph('texts'),
+          algorithms.build_pmi_graph('texts'), algorithms.build_yandex_maps_graph('travel_times', 'lengths')]
+for g in graphs:
+    for graph in g._topological_sort()[0]:
+        for node in graph._nodes:
+            if not isinstance(node, graph_module.Join):
+                print(node.fingerprint({}).hex())
+"""
+
+
+def test_callable_fingerprint_is_stable_across_processes():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    fingerprints = [subprocess.run([sys.executable, '-c', NODE_FINGERPRINTS_SCRIPT], cwd=root, check=True,
+                                   stdout=subprocess.PIPE, universal_newlines=True).stdout
+                    for _ in range(2)]
+
+    assert fingerprints[0]
+    assert fingerprints[0] == fingerprints[1]
+
+
+def test_callable_fingerprint_unstable_values():
+
+    class Scale(object):
+        pass
+
+    namespace = {'SCALE': Scale()}
+    exec("def mapper(record):\n    yield {'v': record['v'] * SCALE.factor}", namespace)
+
+    assert graph_module.callable_fingerprint(namespace['mapper']) is None
+    assert graph_module.Map(namespace['mapper']).fingerprint({}) is None
+
+
+def test_output_stream(monkeypatch):
+    monkeypatch.setattr(graph_module, 'OUTPUT_BUFFER_SIZE', 16)
+    table = [
+        {'value': 1, 'text': 'some text'},
+        {'value': 123, 'text': 'привет'},
+        {'value': 55, 'text': 'hi'}
+    ]
+
+    my_graph = Graph(source='table')
+
+    text_stream = io.StringIO()
+    assert my_graph.run(table=table, output_stream=text_stream) == []
+    assert [json.loads(line) for line in text_stream.getvalue().splitlines()] == table
+
+    binary_stream = io.BytesIO()
+    assert my_graph.run(table=table, output_stream=binary_stream) == []
+    assert [json.loads(line) for line in binary_stream.getvalue().splitlines()] == table
+
+    # format of lines does not depend on json library
+    assert text_stream.getvalue().splitlines()[1] == '{"value":123,"text":"привет"}'
+
+
+def test_output_stream_big_integers():
+    my_graph = Graph(source='table')
+
+    stream = io.StringIO()
+    my_graph.run(table=[{'value': 2 ** 70}, {'value': 1}], output_stream=stream)
+    assert stream.getvalue().splitlines() == ['{"value":1180591620717411303424}', '{"value":1}']
+
+
+def test_output_stream_text_sinks():
+    table = [{'value': 1, 'text': 'привет'}]
+    my_graph = Graph(source='table')
+
+    with tempfile.SpooledTemporaryFile(mode='w+') as spooled_stream:
+        my_graph.run(table=table, output_stream=spooled_stream)
+        spooled_stream.seek(0)
+        assert [json.loads(line) for line in spooled_stream] == table
+
+    class Writer(object):
+        def __init__(self):
+            self.chunks = []
+
+        def write(self, chunk):
+            self.chunks.append(chunk)
+
+    writer = Writer()
+    my_graph.run(table=table, output_stream=writer)
+    assert all(isinstance(chunk, str) for chunk in writer.chunks)
+    assert [json.loads(line) for line in ''.join(writer.chunks).splitlines()] == table
+
+
+def test_output_stream_chunks(monkeypatch):
+    monkeypatch.setattr(graph_module, 'OUTPUT_BUFFER_SIZE', 16)
+    table = [{'value': value, 'text': 'some text'} for value in range(5)]
+
+    class BinaryWriter(io.RawIOBase):
+        def __init__(self):
+            self.chunks = []
+
+        def write(self, chunk):
+            # keeps chunks without copying them
+            self.chunks.append(chunk)
+            return len(chunk)
+
+    writer = BinaryWriter()
+    Graph(source='table').run(table=table, output_stream=writer)
+    assert len(writer.chunks) == 5
+    assert [json.loads(line) for line in b''.join(writer.chunks).splitlines()] == table